@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import lzma
+import time
+import zlib
+import struct
+import optparse
+import collections
+import concurrent.futures
+import numpy as np
+
+from EventParser import EventParser
+
+class Codec:
+    """Compress one block of big-endian words.
+
+    With shuffle=True the bytes of the words are regrouped by position
+    (all most significant bytes first, ...) before compression. The frame
+    bits and the zero upper bits of the 12-bit values then form long runs,
+    which compress much better than the interleaved words.
+    """
+    name = None
+
+    def __init__(self, shuffle=True):
+        self.shuffle = shuffle
+
+    def compress(self, data):
+        if self.shuffle:
+            data = np.frombuffer(data, dtype=np.uint8).reshape(-1, 4).T.tobytes()
+        return self.compress_bytes(data)
+
+    def decompress(self, data):
+        data = self.decompress_bytes(data)
+        if self.shuffle:
+            data = np.frombuffer(data, dtype=np.uint8).reshape(4, -1).T.tobytes()
+        return data
+
+    def compress_bytes(self, data):
+        raise NotImplementedError
+
+    def decompress_bytes(self, data):
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+
+    def __init__(self, shuffle=True, level=1):
+        super().__init__(shuffle)
+        self.level = level
+
+    def compress_bytes(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress_bytes(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+
+    def __init__(self, shuffle=True, preset=1):
+        super().__init__(shuffle)
+        self.preset = preset
+
+    def compress_bytes(self, data):
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2, 'preset': self.preset}])
+
+    def decompress_bytes(self, data):
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2}])
+
+
+# name -> codec class; add an entry to support another codec
+CODECS = {codec.name: codec for codec in (ZlibCodec, LzmaCodec)}
+
+
+class BlockFile:
+    """Layout of a compressed data file (.blk).
+
+    header   magic, version, format flags, shuffle flag, codec name, metadata length
+    metadata run settings as JSON
+    blocks   block header (compressed size, raw size, events) + compressed words;
+             every block holds whole events and is compressed on its own
+    index    one INDEX_DTYPE entry per block
+    footer   index offset, block count, end magic
+
+    The index at the end gives random access to any block. A file whose
+    writer did not close it (no footer) is indexed by walking the block
+    headers.
+    """
+    MAGIC = b'EASIBLK1'
+    END_MAGIC = b'EASIEND1'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIII8sI')  # magic, version, flags, shuffle, codec, metadata length
+    BLOCK = struct.Struct('<III')  # compressed size, raw size, events
+    FOOTER = struct.Struct('<QQ8s')  # index offset, block count, end magic
+    INDEX_DTYPE = np.dtype([('offset', '<u8'), ('compressed', '<u4'), ('size', '<u4'),
+                            ('first_event', '<u8'), ('events', '<u4')])
+    NEW_FORMAT = 0x1
+    DECODED = 0x2
+
+
+class BlockWriter:
+    """Write whole events into independently compressed blocks.
+
+    write() takes the bytes of the event stream in any pieces; they are
+    cut into blocks of about `block_size` bytes at event boundaries. The
+    blocks are compressed by a pool of `workers` threads (zlib and lzma
+    release the GIL) and written in order, so neither the receiver nor
+    the writer thread of an EventPipeline waits for the compression of
+    one block at a time.
+    """
+    def __init__(self, filename, new_format, decoded=True, codec='zlib', metadata=None,
+                 block_size=1 << 22, workers=2):
+        self.name = filename
+        self.codec = CODECS[codec]() if isinstance(codec, str) else codec
+        self.parser = EventParser(new_format, decoded)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.ends = np.zeros(0, dtype=np.int64)  # byte offset in self.buffer of the end of each complete event
+        self.position = 0  # offset of self.buffer in the event stream
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()  # (future, raw size, events), in file order
+        self.max_pending = 2 * workers
+        self.index = []
+        self.event_count = 0
+        self.byte_count = 0
+        self.compressed_count = 0
+
+        self.file = open(filename, 'wb')
+        metadata = json.dumps(metadata or {}).encode()
+        flags = (BlockFile.NEW_FORMAT if new_format else 0) | (BlockFile.DECODED if decoded else 0)
+        self.file.write(BlockFile.HEADER.pack(BlockFile.MAGIC, BlockFile.VERSION, flags, int(self.codec.shuffle),
+                                              self.codec.name.encode(), len(metadata)))
+        self.file.write(metadata)
+
+    def write(self, data):
+        data = memoryview(data).cast('B')  # e.g. a '>u4' array
+        self.buffer += data
+        complete = int(self.ends[-1]) if len(self.ends) else 0
+        with memoryview(self.buffer) as view:  # released before the buffer is resized
+            # headers only: the words are stored as they are, so a bad data word must not stop the run
+            _, ends = self.parser.frame(view[complete:], self.position + complete)
+        self.ends = np.concatenate((self.ends, complete + 4 * ends))
+        while len(self.ends) and self.ends[-1] >= self.block_size:
+            # the first event boundary at or after block_size
+            self.cut(int(np.searchsorted(self.ends, self.block_size)) + 1)
+        return len(data)
+
+    def cut(self, events=None):
+        """Hand the first `events` complete events (default all) of the buffer to the compression pool."""
+        events = len(self.ends) if events is None else events
+        if events == 0:
+            return
+        size = int(self.ends[events - 1])
+        block = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.ends = self.ends[events:] - size
+        self.position += size
+        self.pending.append((self.pool.submit(self.codec.compress, block), size, events))
+        while len(self.pending) > self.max_pending:
+            self.write_block()
+
+    def write_block(self):
+        future, size, events = self.pending.popleft()
+        compressed = future.result()
+        self.file.write(BlockFile.BLOCK.pack(len(compressed), size, events))
+        self.index.append((self.file.tell(), len(compressed), size, self.event_count, events))
+        self.file.write(compressed)
+        self.event_count += events
+        self.byte_count += size
+        self.compressed_count += len(compressed) + BlockFile.BLOCK.size
+
+    def flush(self):
+        """Compress and write everything complete so far."""
+        self.cut()
+        while self.pending:
+            self.write_block()
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.flush()
+            if len(self.buffer):
+                print(f"{self.name}: {len(self.buffer)} bytes of an incomplete event not written")
+            index_offset = self.file.tell()
+            self.file.write(np.array(self.index, dtype=BlockFile.INDEX_DTYPE).tobytes())
+            self.file.write(BlockFile.FOOTER.pack(index_offset, len(self.index), BlockFile.END_MAGIC))
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+            self.file = None
+
+    def statistics(self):
+        return {
+            'events': self.event_count,
+            'bytes': self.byte_count,
+            'compressed': self.compressed_count,
+            'blocks': len(self.index),
+            'ratio': self.byte_count / self.compressed_count if self.compressed_count else 0.0,
+        }
+
+    @staticmethod
+    def format(statistics):
+        return (f"{statistics['bytes'] / 1e6:.1f} MB compressed to {statistics['compressed'] / 1e6:.1f} MB "
+                f"(x{statistics['ratio']:.2f}) in {statistics['blocks']} blocks")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BlockReader:
+    """Random access to the events of a .blk file written by BlockWriter."""
+    def __init__(self, filename):
+        self.name = filename
+        self.file = open(filename, 'rb')
+        magic, version, flags, shuffle, codec, metadata_length = BlockFile.HEADER.unpack(
+            self.file.read(BlockFile.HEADER.size))
+        if magic != BlockFile.MAGIC or version != BlockFile.VERSION:
+            raise ValueError(f"{filename} is not a compressed data file")
+        self.new_format = bool(flags & BlockFile.NEW_FORMAT)
+        self.decoded = bool(flags & BlockFile.DECODED)
+        self.codec = CODECS[codec.rstrip(b'\0').decode()](shuffle=bool(shuffle))
+        self.metadata = json.loads(self.file.read(metadata_length))
+        self.data_offset = BlockFile.HEADER.size + metadata_length
+        self.index = self.read_index()
+        self.first_events = self.index['first_event']
+
+    def read_index(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size >= self.data_offset + BlockFile.FOOTER.size:
+            self.file.seek(size - BlockFile.FOOTER.size)
+            index_offset, count, magic = BlockFile.FOOTER.unpack(self.file.read(BlockFile.FOOTER.size))
+            if magic == BlockFile.END_MAGIC:
+                self.file.seek(index_offset)
+                return np.frombuffer(self.file.read(count * BlockFile.INDEX_DTYPE.itemsize), dtype=BlockFile.INDEX_DTYPE)
+        print(f"{self.name}: no block index (file not closed), scanning the blocks")
+        return self.scan(size)
+
+    def scan(self, size):
+        index = []
+        position = self.data_offset
+        event_count = 0
+        while position + BlockFile.BLOCK.size <= size:
+            self.file.seek(position)
+            compressed, raw_size, events = BlockFile.BLOCK.unpack(self.file.read(BlockFile.BLOCK.size))
+            position += BlockFile.BLOCK.size
+            if position + compressed > size:
+                break  # the last block was cut short
+            index.append((position, compressed, raw_size, event_count, events))
+            event_count += events
+            position += compressed
+        return np.array(index, dtype=BlockFile.INDEX_DTYPE)
+
+    def __len__(self):
+        return int(self.first_events[-1] + self.index['events'][-1]) if len(self.index) else 0
+
+    def block(self, i):
+        """Return the decompressed bytes of block i."""
+        entry = self.index[i]
+        self.file.seek(int(entry['offset']))
+        return self.codec.decompress(self.file.read(int(entry['compressed'])))
+
+    def blocks(self):
+        for i in range(len(self.index)):
+            yield self.block(i)
+
+    def read_events(self, first, count=1):
+        """Return (words, starts, ends) of `count` events from event `first`, as EventParser.parse() does.
+
+        Fewer events are returned when the file ends before.
+        """
+        if count <= 0:
+            raise ValueError(f"count must be positive, not {count}")
+        if not 0 <= first < len(self):
+            raise IndexError(f"event {first} out of range, {self.name} holds {len(self)} events")
+        last = min(first + count, len(self))
+        begin = int(np.searchsorted(self.first_events, first, side='right')) - 1
+        end = int(np.searchsorted(self.first_events, last, side='left'))
+        data = b''.join(self.block(i) for i in range(begin, end))
+        words, starts, ends, _ = EventParser(self.new_format, self.decoded).parse(data)
+        skip = first - int(self.first_events[begin])
+        offset = starts[skip]
+        return words[offset:ends[skip + last - first - 1]], starts[skip:skip + last - first] - offset, \
+            ends[skip:skip + last - first] - offset
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <.blk file>')
+    parser.add_option('-o', '--output', dest='output', default=None, help='decompress into this bare data file')
+    parser.add_option('-e', '--event', dest='event', type='int', default=None, help='print event N')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    with BlockReader(args[0]) as reader:
+        size = int(reader.index['size'].sum())
+        compressed = int(reader.index['compressed'].sum())
+        print(f"{args[0]}: {len(reader)} events in {len(reader.index)} {reader.codec.name} blocks, "
+              f"{size / 1e6:.1f} MB compressed to {compressed / 1e6:.1f} MB")
+        for key, value in reader.metadata.items():
+            print(f"  {key}: {value}")
+        if options.event is not None:
+            words, starts, ends = reader.read_events(options.event)
+            print(f"event {options.event}: header 0x{int(words[0]):08X}")
+            print(" ".join(f"{int(word):08X}" for word in words[1:ends[0]]))
+        if options.output:
+            start = time.monotonic()
+            with open(options.output, 'wb') as output:
+                for block in reader.blocks():
+                    output.write(block)
+            print(f"Decompressed to {options.output} at {size / 1e6 / max(time.monotonic() - start, 1e-9):.0f} MB/s")
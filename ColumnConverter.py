@@ -0,0 +1,128 @@
+import os
+import sys
+import glob
+import time
+import optparse
+import numpy as np
+
+from EasirocDataFile import EasirocDataFile
+
+class ColumnConverter:
+    """Convert a data file into columns, one .npy file per column.
+
+    Data words are classified as VmeEasiroc.hg(), lg() and tdc() do, for
+    all words of a block of events at once:
+
+      adc_event, adc_channel, adc_gain (0: HG, 1: LG), adc_value
+      tdc_event, tdc_channel, tdc_edge (0: leading, 1: trailing), tdc_value
+
+    where event is the index of the event in the file. A first pass counts
+    the ADC and TDC words so that every column is created at its final
+    size with numpy.lib.format.open_memmap and filled block by block; the
+    memory used depends on `chunk_events`, not on the size of the file.
+    The columns can be opened again with load(..., mmap_mode='r').
+    """
+    # event is uint32, or int64 for files of more than 2**32 events
+    ADC_COLUMNS = {'event': np.uint32, 'channel': np.uint8, 'gain': np.uint8, 'value': np.uint16}
+    TDC_COLUMNS = {'event': np.uint32, 'channel': np.uint8, 'edge': np.uint8, 'value': np.uint16}
+
+    def __init__(self, data_file, chunk_events=1 << 16):
+        self.data_file = data_file  # EasirocDataFile
+        self.chunk_events = chunk_events
+
+    def count(self):
+        """Return the number of (ADC, TDC) words of the file."""
+        adc_count = tdc_count = 0
+        for words, starts, _ in self.data_file.chunks(self.chunk_events):
+            adc, tdc = self.count_block(words, starts)
+            adc_count += adc
+            tdc_count += tdc
+        return adc_count, tdc_count
+
+    def convert(self, directory):
+        """Write the columns to directory/<column>.npy; return the number of (ADC, TDC) words."""
+        adc_count, tdc_count = self.count()
+        adc, tdc = self.create_columns(directory, adc_count, tdc_count, len(self.data_file))
+        adc_position = tdc_position = 0
+        first_event = 0
+        for words, starts, _ in self.data_file.chunks(self.chunk_events):
+            adc_n, tdc_n = self.fill_block(adc, tdc, words, starts, first_event, adc_position, tdc_position)
+            adc_position += adc_n
+            tdc_position += tdc_n
+            first_event += len(starts)
+        for column in list(adc.values()) + list(tdc.values()):
+            column.flush()
+        return adc_count, tdc_count
+
+    @staticmethod
+    def count_block(words, starts):
+        """Return the number of (ADC, TDC) data words of a block of events."""
+        # count over the whole block, then take the headers back out
+        tdc = int(np.count_nonzero(words & (1 << 21))) - int(np.count_nonzero(words[starts] & (1 << 21)))
+        return len(words) - len(starts) - tdc, tdc
+
+    @staticmethod
+    def fill_block(adc, tdc, words, starts, first_event, adc_position, tdc_position):
+        """Classify the data words of a block into the columns from the given rows; return the (ADC, TDC) rows written."""
+        is_header = np.zeros(len(words), dtype=bool)
+        is_header[starts] = True
+        event = np.cumsum(is_header) - 1 + first_event  # of every word
+        is_tdc = (words & (1 << 21)) != 0
+        written = []
+        for columns, selection, position, kind in ((adc, ~is_tdc & ~is_header, adc_position, 'gain'),
+                                                   (tdc, is_tdc & ~is_header, tdc_position, 'edge')):
+            index = np.flatnonzero(selection)
+            n = len(index)
+            selected = words[index].astype(np.uint32)
+            columns['event'][position:position + n] = event[index]
+            columns['channel'][position:position + n] = (selected >> 13) & 0x3F
+            columns[kind][position:position + n] = (selected >> 19) & 1
+            columns['value'][position:position + n] = selected & 0x0FFF
+            written.append(n)
+        return tuple(written)
+
+    @classmethod
+    def create_columns(cls, directory, adc_count, tdc_count, event_count):
+        """Create the column files at their final size; return the (adc, tdc) dicts of writable memmaps."""
+        os.makedirs(directory, exist_ok=True)
+        event_dtype = np.uint32 if event_count <= np.iinfo(np.uint32).max else np.int64
+        return tuple({name: np.lib.format.open_memmap(os.path.join(directory, f'{prefix}_{name}.npy'), mode='w+',
+                                                      dtype=event_dtype if name == 'event' else dtype, shape=(count,))
+                      for name, dtype in columns.items()}
+                     for prefix, columns, count in (('adc', cls.ADC_COLUMNS, adc_count),
+                                                    ('tdc', cls.TDC_COLUMNS, tdc_count)))
+
+    @staticmethod
+    def load(directory, mmap_mode='r'):
+        """Return {'adc_value': array, ...} for the columns in `directory`."""
+        return {os.path.basename(path)[:-len('.npy')]: np.load(path, mmap_mode=mmap_mode)
+                for path in sorted(glob.glob(os.path.join(directory, '*.npy')))}
+
+    @classmethod
+    def bundle(cls, directory, filename):
+        """Store the columns of `directory` in one uncompressed .npz file."""
+        np.savez(filename, **cls.load(directory))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <data file> ...')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='output directory (default: <data file>_columns, one file only)')
+    parser.add_option('-c', '--chunk', dest='chunk', type='int', default=1 << 16, help='events converted at once')
+    parser.add_option('-z', '--npz', dest='npz', action='store_true', help='also bundle the columns into <output>.npz')
+    (options, args) = parser.parse_args()
+    if not args or (options.output and len(args) > 1):
+        parser.print_help()
+        sys.exit(1)
+
+    for filename in args:
+        directory = options.output or f"{os.path.splitext(filename)[0]}_columns"
+        start = time.monotonic()
+        with EasirocDataFile(filename) as data_file:
+            adc_count, tdc_count = ColumnConverter(data_file, options.chunk).convert(directory)
+            size = 4 * len(data_file.words)
+        elapsed = time.monotonic() - start
+        print(f"{filename}: {adc_count} ADC and {tdc_count} TDC words to {directory}/ "
+              f"in {elapsed:.2f} s ({size / 1e6 / max(elapsed, 1e-9):.0f} MB/s)")
+        if options.npz:
+            ColumnConverter.bundle(directory, f"{directory}.npz")
+            print(f"Bundled into {directory}.npz")
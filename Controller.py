@@ -7,13 +7,17 @@ import time
 import subprocess
 import yaml
 import optparse
-import struct
 
 from queue import Queue
 from datetime import datetime
 from tqdm import tqdm
 
 from VME_EASIROC import VmeEasiroc
+from RBCPTracer import RBCPTracer
+from EventPipeline import EventPipeline, SubrunFiles, SubrunSplitter, unique_filename
+from EventIndex import IndexedFile
+from BlockFile import BlockWriter, CODECS
+from HistogramEngine import HistogramEngine
 # Set environment variable equivalent to ENV['INLINEDIR']
 os.environ['INLINEDIR'] = os.path.dirname(os.path.abspath(__file__))
 
@@ -26,13 +30,16 @@ class CommandDispatcher:
         'regacyDataFormat', 'reset', 'help', 'version', 
         'timeStamp', 'exit', 'quit', 'progress', 'stop', 'makeError', 'setStpMode', 
         'setTESTPIN', 'setTestCharge', 'setTriggerMode', 'setTriggerDelay', 
-        'show_easiroc1', 'show_easiroc2', 'slowcontrol_only', 'testChargeTo', 'dummy_read'
+        'show_easiroc1', 'show_easiroc2', 'slowcontrol_only', 'testChargeTo', 'dummy_read',
+        'trace', 'verify', 'continuous', 'histogram'
     ]
 
     def __init__(self, vme_easiroc, q):
         self.vme_easiroc = vme_easiroc
         self.q = q
         self.stop_requested = False
+        # spectra of the running (or last) 'read'/'continuous', see 'histogram'
+        self.histograms = HistogramEngine()
         self.setStpMode(0)
         # Run initial commands for .rc hidden file
         run_command_file = os.path.join('./.rc')
@@ -69,6 +76,8 @@ class CommandDispatcher:
             print(f"{e} invalid argument '{' '.join(args)}' for command '{command}'")
         except Exception as e:
             print(f'Exception {str(e)}')
+            if self.vme_easiroc.rbcp.tracer is not None:
+                self.trace('dump')
             print("exit...")
             self.setHV(0.0)
             time.sleep(1)
@@ -267,30 +276,18 @@ class CommandDispatcher:
     def muxControl(self, chnum):
         self.vme_easiroc.set_ch(int(chnum))
 
-    def slowcontrol(self):
+    def slowcontrol(self, option=None):
+        if option not in [None, 'force']:
+            print(f"Unknown argument {option}")
+            return
         self.vme_easiroc.reload_setting()
-        self.vme_easiroc.send_slow_control()
-        self.vme_easiroc.send_probe_register()
-        self.vme_easiroc.send_read_register()
-        self.vme_easiroc.send_pedestal_suppression()
-        self.vme_easiroc.send_selectable_logic()
-        self.vme_easiroc.send_trigger_pla()
-        self.vme_easiroc.send_trigger_width()
-        self.vme_easiroc.send_time_window()
-        self.vme_easiroc.send_usr_clk_out_register()
-        self.vme_easiroc.send_trigger_values()
-
-    def slowcontrol_only(self):
-        self.vme_easiroc.send_slow_control()
-        self.vme_easiroc.send_probe_register()
-        self.vme_easiroc.send_read_register()
-        self.vme_easiroc.send_pedestal_suppression()
-        self.vme_easiroc.send_selectable_logic()
-        self.vme_easiroc.send_trigger_pla()
-        self.vme_easiroc.send_trigger_width()
-        self.vme_easiroc.send_time_window()
-        self.vme_easiroc.send_usr_clk_out_register()
-        self.vme_easiroc.send_trigger_values()
+        self.vme_easiroc.send_configuration(force=(option == 'force'))
+
+    def slowcontrol_only(self, option=None):
+        if option not in [None, 'force']:
+            print(f"Unknown argument {option}")
+            return
+        self.vme_easiroc.send_configuration(force=(option == 'force'))
 
     def adc(self, on_off):
         print(f"Set ADC {on_off}")
@@ -381,46 +378,164 @@ class CommandDispatcher:
             time.sleep(1)
             print(f'{i}/{events} {dummystring}')
         
-    def read(self, events, filename="temp", mode="default"):
+    def read(self, events, filename="temp", mode="default", codec=None):
         print("Begin of read.")
         events = int(events)
-        if not filename.endswith('.dat'):
-            filename += '.dat'
+        if mode in CODECS:
+            mode, codec = "default", mode  # 'read <EventNum> <FileName> zlib'
+        if codec is not None and codec not in CODECS:
+            print(f"Unknown codec {codec}: {' or '.join(CODECS)}")
+            return
+        # compressed runs go to a .blk file of independently compressed blocks
+        suffix = '.dat' if codec is None else '.blk'
+        if not filename.endswith(suffix):
+            filename = filename.removesuffix('.dat') + suffix
 
         # check presence of directory
         if not os.path.exists('data'):
             os.makedirs('data')
             
-        data_filename = f'data/{filename}'
-        if os.path.exists(data_filename):
-            print(f"{data_filename} already exists.")
-            data_filename = f"{data_filename.removesuffix('.dat')}_{int(time.time())}.dat"
+        data_filename = unique_filename(f'data/{filename}')
 
         print(f"Save as {data_filename} {events} events")
 
         self.stop_requested = False
         
         if mode == "default":
-            with open(data_filename, 'wb') as file:
-                with tqdm(total=events, desc="Processing", ncols=100, unit="event") as progress_bar:
-                    # Read event data and wirte to output
-                    for header, data in self.vme_easiroc.read_event(events):
-                        # Stop
-                        if self.stop_requested:
-                            print("Measurement stopped by user but nothing happen")
-                            # break
-                        # Add Header
-                        file.write(header['header'])
-                        # Pack data
-                        file.write(struct.pack('!{}I'.format(len(data)), *data))
-                        # Update progress bar
-                        progress_bar.update(1)
+            source = self.decoded_events(events)
+            desc = "Processing"
+        elif mode == "raw":
+            # Stream as received from the module (legacy data stays 7-bit packed), decode offline
+            source = self.vme_easiroc.read_raw(events)
+            desc = "Recording"
+        else:
+            print("Invalid mode... 'default' or 'raw'")
+            return
+
+        # Receive on this thread, write on a writer thread through a bounded ring;
+        # the event offsets and run settings go to the .idx file next to it
+        metadata = dict(self.vme_easiroc.run_metadata(), mode=mode)
+        if codec is None:
+            file = IndexedFile(data_filename, self.vme_easiroc.new_format, mode == "default", metadata)
         else:
-            print("Invalid mode... 'default'")
+            # compressed by a thread pool fed from the writer thread, with a block index at the end
+            file = BlockWriter(data_filename, self.vme_easiroc.new_format, mode == "default", codec, metadata)
+        # raw data is not decoded here, the histograms keep those of the last decoded run
+        if mode == "default":
+            self.histograms.reset()
+            self.histograms.start()
+        try:
+            with file:
+                with tqdm(total=events, desc=desc, ncols=100, unit="event") as progress_bar:
+                    statistics = EventPipeline(source, file, progress=progress_bar.update).run()
+        finally:
+            if mode == "default":
+                self.histograms.stop()
+        print(f"Pipeline: {EventPipeline.format(statistics)}")
+        if codec is not None:
+            print(f"Compression: {BlockWriter.format(file.statistics())}")
+
+        self.slowcontrol()
+
+    def decoded_events(self, events):
+        # Write the events of each received chunk as they arrive; a chunk is bounded in bytes, so it fits a ring slot
+        for words, starts, ends in self.vme_easiroc.daq_stream(self.vme_easiroc.receive_parsed(events)):
+            # Stop
+            if self.stop_requested:
+                print("Measurement stopped by user but nothing happen")
+                # break
+            if len(starts) == 0:
+                continue
+            self.histograms.submit(words[:ends[-1]], starts=starts)
+            # header and data words are contiguous, as written
+            yield words[:ends[-1]].astype('>u4'), len(starts)
+
+    def continuous(self, filename, rotate, subruns="0"):
+        """Stay in DAQ mode and rotate output files, e.g. 'continuous run events=100000 10'."""
+        kind, _, value = rotate.partition('=')
+        if kind not in ['events', 'bytes', 'seconds'] or not value:
+            print(f"Unknown argument {rotate}: events=<N>, bytes=<N> or seconds=<N>")
             return
+        splitter = SubrunSplitter(**{f'max_{kind}': float(value) if kind == 'seconds' else int(value)})
+        subruns = int(subruns)  # 0: until 'quit'/STOP
+
+        if not os.path.exists('data'):
+            os.makedirs('data')
+        filename = filename.removesuffix('.dat')
+        print(f"Continuous DAQ: data/{filename}_<subrun>.dat, new subrun every {value} {kind}")
+
+        self.stop_requested = False
+        metadata = self.vme_easiroc.run_metadata()
+        opener = lambda name: IndexedFile(name, self.vme_easiroc.new_format, True, metadata)
+        self.histograms.reset()
+        self.histograms.start()
+        try:
+            with SubrunFiles(f'data/{filename}_{{index:04d}}.dat', opener=opener) as files:
+                with tqdm(desc="Recording", ncols=100, unit="event") as progress_bar:
+                    statistics = EventPipeline(self.subrun_events(splitter, subruns), files,
+                                               progress=progress_bar.update).run()
+        finally:
+            self.histograms.stop()
+        print(f"{files.index} subrun(s) completed: {', '.join(files.filenames)}")
+        print(f"Pipeline: {EventPipeline.format(statistics)}")
 
         self.slowcontrol()
 
+    def subrun_events(self, splitter, subruns):
+        completed = 0
+        # take the events of every received chunk as they come, so that time rotation and stop stay prompt;
+        # the receive timeout keeps them prompt without triggers too
+        stream = self.vme_easiroc.daq_stream(self.vme_easiroc.receive_parsed(None, timeout=0.5))
+        try:
+            for words, starts, ends in stream:
+                first = 0
+                for piece, events, last in splitter.split(words.astype('>u4'), ends):
+                    if events:
+                        # only the events that are written
+                        offset = starts[first]
+                        self.histograms.submit(words[offset:ends[first + events - 1]],
+                                               starts=starts[first:first + events] - offset)
+                    first += events
+                    yield piece, events, last
+                    completed += last
+                    if subruns and completed >= subruns:
+                        return
+                if len(ends) == 0:
+                    yield words[:0], 0  # lets the pipeline flush what it holds
+                if self.stop_requested:
+                    print("Continuous DAQ stopped by user")
+                    return
+        finally:
+            stream.close()  # leave DAQ mode and close the connection now, not when collected
+
+    def histogram(self, action="show", *args):
+        """Spectra filled during 'read' (default mode) and 'continuous', e.g. 'histogram show HG 0 1 2'."""
+        if action == "reset":
+            self.histograms.reset()
+        elif action == "save":
+            filename = args[0] if args else f"histogram_{int(time.time())}"
+            if not os.path.exists('data'):
+                os.makedirs('data')
+            self.histograms.save(f"data/{filename}.npz")
+            print(f"Save as data/{filename}.npz")
+        elif action == "show":
+            kind = args[0] if args else "HG"
+            if kind not in ['HG', 'LG', 'TDC']:
+                print(f"Unknown argument {kind}: HG, LG or TDC")
+                return
+            counts, statistics = self.histograms.snapshot()
+            entries, mean, rms = self.histograms.summary(counts)
+            print(f"{statistics['events']} events, {statistics['words']} words, "
+                  f"{statistics['dropped_batches']} batches dropped")
+            # TDC: leading and trailing edges
+            kinds = [2, 3] if kind == "TDC" else [HistogramEngine.KINDS.index(kind)]
+            for ich in (map(int, args[1:]) if len(args) > 1 else range(64)):
+                print(f"ch{ich:2d} " + "  ".join(f"{HistogramEngine.KINDS[k]}: {entries[k, ich]:8d} entries, "
+                                                 f"mean {mean[k, ich]:7.1f}, rms {rms[k, ich]:6.1f}"
+                                                 for k in kinds))
+        else:
+            print(f"Unknown argument {action}: show [HG|LG|TDC] [ch...], save [file] or reset")
+
     def fit(self, filename="temp", *ch):
         status_filename = f"status/{filename}.yml"
         with open(status_filename, 'r') as file:
@@ -462,6 +577,36 @@ class CommandDispatcher:
         elif target == 'triggerPla':
             self.vme_easiroc.reset_trigger_pla()
 
+    def trace(self, action, argument=None):
+        if action == 'on':
+            tracer = RBCPTracer(int(argument) if argument else 4096)
+            self.vme_easiroc.rbcp.tracer = tracer
+            self.vme_easiroc.async_rbcp.tracer = tracer
+            print(f"RBCP tracing on, keeping the last {tracer.capacity} transactions")
+        elif action == 'off':
+            self.vme_easiroc.rbcp.tracer = None
+            self.vme_easiroc.async_rbcp.tracer = None
+            print("RBCP tracing off")
+        elif action == 'dump':
+            tracer = self.vme_easiroc.rbcp.tracer
+            if tracer is None:
+                print("RBCP tracing is off")
+                return
+            filename = argument or f"rbcp_trace_{int(time.time())}.bin"
+            tracer.dump(filename)
+            print(f"RBCP trace saved to {filename}, decode with 'python RBCPTracer.py {filename}'")
+        else:
+            print(f"Unknown argument {action}")
+
+    def verify(self):
+        mismatches = self.vme_easiroc.verify_configuration()
+        if not mismatches:
+            print("Configuration verified: module matches the settings")
+            return
+        for region, address, expected, read in mismatches:
+            print(f"{region}: 0x{address:08X} expected 0x{expected:02X}, read 0x{read:02X}")
+        print(f"{len(mismatches)} mismatch(es), run 'slowcontrol' to resend the affected registers")
+
     def timeStamp(self):
         current_time = time.localtime()
         print(f"Time stamp: {time.strftime('%Y-%m-%d %H:%M:%S', current_time)}, {int(time.time())}")
@@ -470,8 +615,9 @@ class CommandDispatcher:
         print("""
         How to use:
         setHV <bias voltage>    input <bias voltage>; 0.00~90.00V to MPPC
-        slowcontrol             transmit SlowControl
-        read <EventNum> <FileName>  read <EventNum> events and write to <FileName>
+        slowcontrol [force]     transmit SlowControl (only changed registers unless 'force')
+        read <EventNum> <FileName> [raw] [zlib|lzma]  read <EventNum> events and write to <FileName>
+                                    ('raw' stores the stream undecoded, a codec compresses it to a .blk file)
         reset probe|readregister    reset setting
         help                    print this message
         version                 print version number
@@ -484,15 +630,17 @@ class CommandDispatcher:
         - exit
         - muxControl <ch(0..32)>
         - quit
-        - read <EventNum> <FileName>
+        - read <EventNum> <FileName> [default/raw] [zlib/lzma]
         - regacyDataFormat <on/off>
+        - continuous <FileName> <events=N/bytes=N/seconds=N> [subruns]
+        - histogram <show [HG/LG/TDC] [ch...]/save [FileName]/reset>
         - reset <probe/readregister/pedestalsuppression/triggerPla>
         - scaler <on/off>
         - stp <on/off>
         - setHV  <bias voltage (00.00~90.00)>
         - increaseHV <bias voltage>
         - decreaseHV
-        - slowcontrol
+        - slowcontrol [force]
         - statusInputDAC <ch(0..63) / all(64)>
         - statusHV
         - statusTemp
@@ -503,6 +651,8 @@ class CommandDispatcher:
         - setTriggerMode <0: ,>
         - setTriggerDelay <0: ,>
         - tdc <on/off>
+        - trace <on [capacity]/off/dump [filename]>
+        - verify
         - version
         - initialCheck
         - read
@@ -510,7 +660,7 @@ class CommandDispatcher:
         """)
 
     def version(self):
-        version_major, version_minor, version_hotfix, version_patch, year, month, day = self.vme_easiroc.version
+        version_major, version_minor, version_hotfix, version_patch, year, month, day = self.vme_easiroc.version()
         print(f"v.{version_major}.{version_minor}.{version_hotfix}-p{version_patch}")
         print(f"Synthesized on {year}-{month}-{day}")
 
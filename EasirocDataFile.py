@@ -0,0 +1,153 @@
+import os
+import sys
+import mmap
+import time
+import optparse
+import numpy as np
+
+from EventIndex import EventIndex
+from EventParser import EventParser
+
+class EasirocDataFile:
+    """Read-only, memory-mapped view of a data file written by 'read' or 'continuous'.
+
+    The file is mapped, not read: `words` is a big-endian uint32 array over
+    the mapping and every event or chunk returned is a slice of it, so
+    nothing is copied until it is used. The header offsets come from the
+    .idx file when there is one, otherwise from one vectorized scan of
+    the words. Decoded files (new or legacy format) are returned as is;
+    raw legacy files ('read ... raw') are decoded per access.
+    """
+    SCAN_WORDS = 1 << 24  # words scanned at once, bounds the temporary arrays
+
+    def __init__(self, filename, new_format=None, decoded=None):
+        self.name = filename
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size >= 4:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.words = np.frombuffer(self.mmap, dtype='>u4', count=size // 4)
+        else:
+            self.mmap = None
+            self.words = np.zeros(0, dtype='>u4')
+        if new_format is None:
+            if len(self.words) == 0:
+                raise ValueError(f"{filename} holds no event")
+            new_format, decoded = EventParser.detect(int(self.words[0]))
+        self.new_format = new_format
+        self.decoded = bool(decoded) or new_format
+        self.parser = EventParser(new_format, self.decoded)
+        self.starts, self.ends = self.load_index()
+        if self.starts is None:
+            self.starts, self.ends = self.scan()
+        complete = np.searchsorted(self.ends, len(self.words), side='right')
+        self.starts, self.ends = self.starts[:complete], self.ends[:complete]
+        # bytes after the last complete event, e.g. a run that was cut short
+        self.truncated = size - 4 * (int(self.ends[-1]) if len(self.ends) else 0)
+
+    def header_sizes(self, headers):
+        if not self.decoded:
+            headers, _ = EventParser.unpack_legacy(headers.astype(np.uint32))
+        return (headers & 0x0FFF).astype(np.int64)
+
+    def load_index(self):
+        """Return the (starts, ends) of the events from the .idx file, or (None, None) if it cannot be used."""
+        try:
+            index = EventIndex.load(self.name)
+        except (FileNotFoundError, ValueError):
+            return None, None
+        if index.stale or index.new_format != self.new_format:
+            return None, None
+        starts = np.asarray(index.offsets, dtype=np.int64) // 4
+        if not np.all(self.parser.is_stored_header(self.words[starts])):
+            return None, None  # written for another file
+        return starts, starts + 1 + self.header_sizes(self.words[starts])
+
+    def scan(self):
+        """Locate every event header in one pass over the words and check that they chain."""
+        starts = np.concatenate([np.flatnonzero(self.parser.is_stored_header(self.words[begin:begin + self.SCAN_WORDS])) + begin
+                                 for begin in range(0, len(self.words), self.SCAN_WORDS)] or [np.zeros(0, np.int64)])
+        if len(self.words) and (len(starts) == 0 or starts[0] != 0):
+            raise ValueError(f"{self.name}: Frame Error 3 at byte 0")
+        ends = starts + 1 + self.header_sizes(self.words[starts])
+        broken = np.flatnonzero(ends[:-1] != starts[1:])
+        if len(broken):
+            i = broken[0]
+            error = "Frame Error 5" if ends[i] > starts[i + 1] else "Frame Error 3"
+            raise ValueError(f"{self.name}: {error} in event {i} at byte {4 * starts[i]}")
+        return starts, ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, n):
+        """Return the words of event n, header first (a view of the file for decoded files)."""
+        words = self.words[self.starts[n]:self.ends[n]]
+        return words if self.decoded else self.parser.decode(words.astype(np.uint32))
+
+    def __iter__(self):
+        """Yield (header, data) for each event, lazily."""
+        for n in range(len(self)):
+            words = self[n]
+            yield int(words[0]), words[1:]
+
+    @property
+    def headers(self):
+        """The decoded header word of every event."""
+        headers = self.words[self.starts].astype(np.uint32)
+        return headers if self.decoded else EventParser.unpack_legacy(headers)[0]
+
+    def chunks(self, events=1 << 16, first=0, last=None):
+        """Yield (words, starts, ends) for blocks of `events` events, as EventParser.parse() does.
+
+        words is a slice of the mapping for decoded files; starts and ends
+        are word offsets into it.
+        """
+        last = len(self) if last is None else min(last, len(self))
+        for begin in range(first, last, events):
+            end = min(begin + events, last)
+            offset = self.starts[begin]
+            words = self.words[offset:self.ends[end - 1]]
+            if not self.decoded:
+                words = self.parser.decode(words.astype(np.uint32))
+            yield words, self.starts[begin:end] - offset, self.ends[begin:end] - offset
+
+    def close(self):
+        self.words = None
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # views handed out are still in use, the mapping goes with the last of them
+            self.mmap = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <data file>')
+    parser.add_option('-e', '--event', dest='event', type='int', default=None, help='print event N')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    start = time.monotonic()
+    with EasirocDataFile(args[0]) as data_file:
+        elapsed = time.monotonic() - start
+        print(f"{args[0]}: {len(data_file)} events, {4 * len(data_file.words) / 1e6:.1f} MB, "
+              f"{'new' if data_file.new_format else 'legacy'} format{'' if data_file.decoded else ', raw'}, "
+              f"opened in {elapsed:.3f} s")
+        if data_file.truncated:
+            print(f"{data_file.truncated} bytes after the last complete event")
+        if len(data_file):
+            sizes = data_file.ends - data_file.starts - 1
+            print(f"data words per event: min {sizes.min()}, mean {sizes.mean():.1f}, max {sizes.max()}")
+        if options.event is not None:
+            words = data_file[options.event]
+            print(f"event {options.event}: header 0x{int(words[0]):08X}")
+            print(" ".join(f"{int(word):08X}" for word in words[1:]))
@@ -0,0 +1,226 @@
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import optparse
+import threading
+import yaml
+
+from RBCP import RBCPHeader
+from VME_EASIROC import VmeEasiroc
+
+class EasirocEmulator:
+    """Stand-in for a VME-EASIROC module on localhost.
+
+    The UDP port answers RBCP reads and writes against an in-memory register
+    map laid out like the FPGA (see the *_address methods of VmeEasiroc).
+    While the DAQ-mode bit of the status register is set, synthetic events
+    are streamed to every client connected to the TCP port, in the legacy
+    7-bit-packed or the new format depending on the new-format bit.
+
+    Data words carry the channel in bits 13-18, the ADC/TDC value in bits
+    0-11, the HG/LG (ADC) or leading/trailing (TDC) flag in bit 19 and the
+    TDC flag in bit 21, matching VmeEasiroc.hg(), lg() and tdc().
+    """
+    REGISTER_SIZE = 0x10400
+    VERSION = bytes([0x31, 0x00, 0x20, 0x16, 0x05, 0x23])  # v3.1.0-p0, 2016-05-23
+    POOL_SIZE = 256
+
+    def __init__(self, host='127.0.0.1', udp_port=4660, tcp_port=24, rate=1000.0, hits=8, seed=None):
+        self.host = host
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.rate = rate  # triggers per second, 0 for as fast as possible
+        self.hits = hits  # channels hit per event
+        self.random = random.Random(seed)
+        self.registers = bytearray(self.REGISTER_SIZE)
+        self.madc_channel = 0
+        self.running = False
+        self.threads = []
+        self.event_pool = None
+
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yaml_common/Calibration.yml')) as file:
+            self.calibration = yaml.safe_load(file)
+
+    def start(self):
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind((self.host, self.udp_port))
+        self.udp_sock.settimeout(0.2)
+        self.udp_port = self.udp_sock.getsockname()[1]
+
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_sock.bind((self.host, self.tcp_port))
+        self.tcp_sock.listen()
+        self.tcp_sock.settimeout(0.2)
+        self.tcp_port = self.tcp_sock.getsockname()[1]
+
+        self.running = True
+        for target in [self.serve_rbcp, self.serve_tcp]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.udp_sock.close()
+        self.tcp_sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    # RBCP
+    def serve_rbcp(self):
+        while self.running:
+            try:
+                packet, peer = self.udp_sock.recvfrom(255 + 8)
+            except socket.timeout:
+                continue
+            if len(packet) < 8 or packet[0] != 0xFF:
+                continue
+            header = RBCPHeader.from_bin(packet)
+            if header.cmd_flag == RBCPHeader.WRITE:
+                data = self.write(header.address, packet[8:8 + header.data_length])
+            elif header.cmd_flag == RBCPHeader.READ:
+                data = self.read(header.address, header.data_length)
+            else:
+                continue
+            cmd_flag = header.cmd_flag | 0x08
+            if data is None:
+                cmd_flag |= 0x01  # bus error
+                data = bytes(header.data_length)
+            reply = RBCPHeader(cmd_flag, header.id, header.data_length, header.address)
+            self.udp_sock.sendto(reply.to_bytes() + data, peer)
+
+    def read(self, address, data_length):
+        if address >= VmeEasiroc.version_address():
+            offset = address - VmeEasiroc.version_address()
+            return (self.VERSION + bytes(256))[offset:offset + data_length]
+        if address + data_length > self.REGISTER_SIZE:
+            return None
+        madc_address = VmeEasiroc.read_madc_address()
+        if address < madc_address + 2 and madc_address < address + data_length:
+            self.registers[madc_address:madc_address + 2] = struct.pack('!H', self.madc_raw(self.madc_channel))
+        return bytes(self.registers[address:address + data_length])
+
+    def write(self, address, data):
+        if address + len(data) > self.REGISTER_SIZE:
+            return None
+        self.registers[address:address + len(data)] = data
+        if address == VmeEasiroc.monitor_adc_address() and data[0] < 8:
+            self.madc_channel = data[0]
+        if address <= VmeEasiroc.status_register_address() < address + len(data):
+            self.event_pool = None  # data format or enabled blocks may have changed
+        return bytes(data)
+
+    def madc_raw(self, channel):
+        madc = self.calibration['MonitorADC']
+        if channel == 3:
+            hv_const = self.calibration['HVControl']
+            hv_dac = struct.unpack('!H', self.registers[VmeEasiroc.hv_control_address():VmeEasiroc.hv_control_address() + 2])[0]
+            voltage = max((hv_dac - hv_const[1]) / hv_const[0], 0.0)
+            return min(max(int((voltage - madc['HVOffset']) / madc['HV']), 0), 0xFFFF)
+        if channel == 4:
+            return int(1.0 / madc['Current'])  # 1 uA
+        if channel in [1, 2]:
+            return int(4.0 / madc['InputDac'])  # 4 V
+        return int((273 + 25) * 65535 * 2.4 / madc['Temperature'])  # 25 C
+
+    # Event stream
+    @property
+    def status(self):
+        return self.registers[VmeEasiroc.status_register_address()]
+
+    def serve_tcp(self):
+        while self.running:
+            try:
+                conn, _ = self.tcp_sock.accept()
+            except socket.timeout:
+                continue
+            thread = threading.Thread(target=self.stream_events, args=(conn,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stream_events(self, conn):
+        with conn:
+            sent = 0
+            start = None
+            while self.running:
+                if not self.status & VmeEasiroc.daq_mode_bit():
+                    start = None
+                    time.sleep(0.001)
+                    continue
+                if start is None:
+                    start, sent = time.monotonic(), 0
+                due = 64 if self.rate <= 0 else min(int((time.monotonic() - start) * self.rate) - sent, 4096)
+                if due <= 0:
+                    time.sleep(0.0005)
+                    continue
+                pool = self.event_pool or self.build_event_pool()
+                chunk = b''.join(pool[(sent + i) % len(pool)] for i in range(due))
+                try:
+                    conn.sendall(chunk)
+                except OSError:
+                    return
+                sent += due
+
+    def build_event_pool(self):
+        self.event_pool = [self.encode_event(self.generate_event()) for _ in range(self.POOL_SIZE)]
+        return self.event_pool
+
+    def generate_event(self):
+        words = []
+        for ch in sorted(self.random.sample(range(64), min(self.hits, 64))):
+            if self.status & VmeEasiroc.send_adc_bit():
+                words.append((ch << 13) | self.random.randrange(800, 4096))               # HG
+                words.append((1 << 19) | (ch << 13) | self.random.randrange(800, 1200))   # LG
+            if self.status & VmeEasiroc.send_tdc_bit():
+                leading = self.random.randrange(0, 3000)
+                words.append((1 << 21) | (ch << 13) | leading)
+                words.append((1 << 21) | (1 << 19) | (ch << 13) | (leading + self.random.randrange(20, 1000)))
+        return words
+
+    def encode_event(self, words):
+        if self.status & VmeEasiroc.new_format_bit():
+            header = 0xFF7C0000 | len(words)
+            words = [0xC0000000 | word for word in words]
+        else:
+            header = (1 << 27) | len(words)
+            words = [self.pack_legacy(header)] + [self.pack_legacy(word) for word in words]
+            return struct.pack(f'>{len(words)}I', *words)
+        return struct.pack(f'>{len(words) + 1}I', header, *words)
+
+    @staticmethod
+    def pack_legacy(word):
+        """Spread a 28-bit word over four 7-bit groups, frame bit set in the first byte."""
+        return (0x80000000 | ((word << 3) & 0x7F000000) | ((word << 2) & 0x007F0000) |
+                ((word << 1) & 0x00007F00) | (word & 0x0000007F))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', dest='host', default='127.0.0.1', help='address to listen on')
+    parser.add_option('--udp-port', dest='udp_port', type='int', default=4660, help='RBCP port')
+    parser.add_option('--tcp-port', dest='tcp_port', type='int', default=24, help='event stream port')
+    parser.add_option('--rate', dest='rate', type='float', default=1000.0, help='trigger rate in Hz (0: unlimited)')
+    parser.add_option('--hits', dest='hits', type='int', default=8, help='channels hit per event')
+    parser.add_option('--seed', dest='seed', type='int', default=None, help='random seed')
+    (options, args) = parser.parse_args()
+
+    emulator = EasirocEmulator(options.host, options.udp_port, options.tcp_port,
+                               options.rate, options.hits, options.seed).start()
+    print(f'Emulating VME-EASIROC on {options.host}: RBCP udp/{emulator.udp_port}, events tcp/{emulator.tcp_port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
+        sys.exit(0)
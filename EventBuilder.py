@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+import numpy as np
+
+class EventBuilder:
+    """Merge the fragments of one trigger recorded by several modules.
+
+    Fragments are matched by a tag, key(header, data), which has to
+    identify the trigger: an event counter or time stamp word. The current
+    data format carries neither, so the key must read one that the
+    firmware adds; matching by arrival order instead would shift every
+    later event after a single lost fragment. Each stream keeps at most
+    `window` unmatched fragments in a reorder buffer; when it is full the
+    oldest fragment is dropped as an orphan, and flush() counts the ones
+    left at the end. Every step is a dict operation, so the cost per event
+    does not grow with the run length.
+
+    For live modules pass the builder to MultiReadout.read(), which puts
+    all modules in DAQ mode before reading any of them.
+    """
+    def __init__(self, key, sources=('parent', 'child'), window=1024):
+        if not callable(key):
+            raise TypeError("key must be a function of (header, data) returning the trigger tag")
+        self.sources = tuple(sources)
+        self.window = window
+        self.key = key
+        self.pending = {source: OrderedDict() for source in self.sources}  # tag -> (header, data)
+        self.last_tag = None
+
+        self.built_count = 0
+        self.orphan_count = {source: 0 for source in self.sources}
+        self.duplicate_count = {source: 0 for source in self.sources}
+        self.high_water = 0
+
+    def add(self, source, header, data):
+        """Add one fragment; return the merged event {source: (header, data)} with its tag, or None."""
+        tag = self.key(header, data)
+        self.last_tag = tag
+
+        pending = self.pending[source]
+        if tag in pending:
+            # a repeated tag (e.g. a counter wrap within the window) leaves the older fragment orphaned
+            del pending[tag]
+            self.duplicate_count[source] += 1
+            self.orphan_count[source] += 1
+        pending[tag] = (header, data)
+
+        if all(tag in self.pending[other] for other in self.sources):
+            self.built_count += 1
+            return tag, {other: self.pending[other].pop(tag) for other in self.sources}
+
+        if len(pending) > self.window:
+            pending.popitem(last=False)
+            self.orphan_count[source] += 1
+        self.high_water = max(self.high_water, len(pending))
+        return None
+
+    def build(self, streams):
+        """Yield (tag, fragments) merged from {source: iterable of (header, data)}, e.g. recorded files.
+
+        The stream whose last tag is the oldest is pulled next, so a stream
+        that lost fragments does not drift away from the others; the build
+        ends with the first stream that ends and the fragments still
+        pending are counted as orphans. The streams are pulled one at a
+        time, so they must not start taking data only when first pulled,
+        as read_event() does: for live modules see MultiReadout.read().
+        """
+        iterators = {source: iter(streams[source]) for source in self.sources}
+        last_tag = {source: None for source in self.sources}
+        try:
+            while True:
+                waiting = [source for source in self.sources if last_tag[source] is None]
+                source = waiting[0] if waiting else min(self.sources, key=last_tag.get)
+                fragment = next(iterators[source], None)
+                if fragment is None:
+                    return
+                event = self.add(source, *fragment)
+                last_tag[source] = self.last_tag
+                if event is not None:
+                    yield event
+        finally:
+            self.flush()
+            for iterator in iterators.values():
+                close = getattr(iterator, 'close', None)
+                if close is not None:
+                    close()
+
+    def words(self, fragments):
+        """Return a merged event in the layout of 'read': the header and data words of each source in turn."""
+        return np.concatenate([np.concatenate(([header], data)) for header, data in
+                               (fragments[source] for source in self.sources)]).astype('>u4')
+
+    def flush(self):
+        """Count the fragments still waiting for a partner as orphans and forget them."""
+        for source, pending in self.pending.items():
+            self.orphan_count[source] += len(pending)
+            pending.clear()
+
+    def statistics(self):
+        return {
+            'built': self.built_count,
+            'orphans': dict(self.orphan_count),
+            'duplicates': dict(self.duplicate_count),
+            'pending': {source: len(pending) for source, pending in self.pending.items()},
+            'high_water': self.high_water,
+        }
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import logging
+import struct
+import optparse
+import numpy as np
+
+from EventParser import EventParser
+
+logger = logging.getLogger(__name__)
+
+class EventIndex:
+    """Offset index of the events of a .dat file, kept in a sidecar .idx file.
+
+    The .dat file itself stays the bare stream of header and data words,
+    so existing readers keep working. The .idx file starts with a header
+    (magic, version, format flags, size of the indexed data and run
+    metadata as JSON) followed by the byte offset of every event header
+    as little-endian uint64, so event N is found with one lookup. The
+    offsets are appended while the data is written and the data size is
+    filled in when the file is closed; rebuild() recreates the index of
+    any bare .dat file.
+    """
+    MAGIC = b'EASIIDX1'
+    VERSION = 2
+    HEADER = struct.Struct('<8sIIIQ')  # magic, version, flags, metadata length, data size
+    DATA_SIZE = struct.Struct('<Q')  # at the end of HEADER
+    NEW_FORMAT = 0x1
+    DECODED = 0x2
+
+    def __init__(self, data_filename, offsets, new_format, decoded, metadata=None, indexed_size=None):
+        self.data_filename = data_filename
+        self.offsets = offsets
+        self.new_format = new_format
+        self.decoded = decoded
+        self.metadata = metadata or {}
+        self.data_size = os.path.getsize(data_filename)
+        self.indexed_size = indexed_size  # 0 while written, or when the recording did not end cleanly
+
+    @property
+    def stale(self):
+        """True unless the index was completed for the data file as it is now."""
+        return self.indexed_size != self.data_size
+
+    @staticmethod
+    def index_filename(data_filename):
+        return os.path.splitext(data_filename)[0] + '.idx'
+
+    @classmethod
+    def load(cls, data_filename):
+        with open(cls.index_filename(data_filename), 'rb') as file:
+            header = file.read(cls.HEADER.size)
+            if len(header) < cls.HEADER.size or header[:8] != cls.MAGIC:
+                raise ValueError(f"{cls.index_filename(data_filename)} is not an event index")
+            magic, version, flags, metadata_length, indexed_size = cls.HEADER.unpack(header)
+            if version != cls.VERSION:
+                raise ValueError(f"{cls.index_filename(data_filename)} is an event index of version {version}")
+            metadata = json.loads(file.read(metadata_length))
+        offsets = np.memmap(cls.index_filename(data_filename), dtype='<u8', mode='r',
+                            offset=cls.HEADER.size + metadata_length)
+        return cls(data_filename, offsets, bool(flags & cls.NEW_FORMAT), bool(flags & cls.DECODED), metadata,
+                   indexed_size)
+
+    @classmethod
+    def open(cls, data_filename):
+        """Load the index of `data_filename`, rebuilding it when it is missing, unreadable or stale."""
+        try:
+            index = cls.load(data_filename)
+        except FileNotFoundError:
+            return cls.rebuild(data_filename)
+        except ValueError:
+            return cls.rebuild(data_filename)  # e.g. of an older version
+        if index.stale:
+            return cls.rebuild(data_filename, index.metadata)
+        return index
+
+    @classmethod
+    def rebuild(cls, data_filename, metadata=None, chunk_size=1 << 24):
+        """Scan a bare .dat file and write its index."""
+        with open(data_filename, 'rb') as file:
+            first = file.read(4)
+            if len(first) < 4:
+                raise ValueError(f"{data_filename} holds no event")
+            new_format, decoded = EventParser.detect(struct.unpack('>I', first)[0])
+            file.seek(0)
+            metadata = dict(metadata or {}, rebuilt=time.strftime('%Y-%m-%d %H:%M:%S'))
+            with EventIndexWriter(data_filename, new_format, decoded, metadata) as writer:
+                while True:
+                    data = file.read(chunk_size)
+                    if not data:
+                        break
+                    writer.add(data)
+        return cls.load(data_filename)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def event_range(self, n):
+        """Return the (start, end) byte offsets of event n in the data file."""
+        start = int(self.offsets[n])
+        end = int(self.offsets[n + 1]) if n + 1 < len(self.offsets) else self.data_size
+        return start, end
+
+    def read_events(self, first, count=1):
+        """Return (words, starts, ends) of `count` events from event `first`, as EventParser.parse() does."""
+        start = int(self.offsets[first])
+        last = first + count
+        end = int(self.offsets[last]) if last < len(self.offsets) else self.data_size
+        with open(self.data_filename, 'rb') as file:
+            file.seek(start)
+            data = file.read(end - start)
+        words, starts, ends, _ = EventParser(self.new_format, self.decoded).parse(data)
+        return words, starts, ends
+
+
+class EventIndexWriter:
+    """Build the index of a data file from the bytes written to it, in order.
+
+    Only the event headers are looked at, as stored (still 7-bit packed in
+    raw legacy streams), and only their chaining is checked: the data
+    words are neither decoded nor checked, which is left to the readers.
+    """
+    def __init__(self, data_filename, new_format, decoded, metadata=None):
+        self.parser = EventParser(new_format, decoded)
+        self.position = 0  # data file offset of the first byte of `carry`
+        self.carry = b''  # bytes of an event not complete yet
+        self.event_count = 0
+        self.failed = False  # set by the owner when add() failed; the index is then left stale
+        metadata = json.dumps(metadata or {}).encode()
+        flags = (EventIndex.NEW_FORMAT if new_format else 0) | (EventIndex.DECODED if decoded else 0)
+        self.file = open(EventIndex.index_filename(data_filename), 'wb')
+        self.file.write(EventIndex.HEADER.pack(EventIndex.MAGIC, EventIndex.VERSION, flags, len(metadata), 0))
+        self.file.write(metadata)
+
+    def add(self, data):
+        """Index the events completed by `data`, the next bytes of the data file."""
+        data = memoryview(data).cast('B')  # e.g. a '>u4' array
+        if self.carry:
+            data = self.carry + bytes(data)
+        starts, ends = self.parser.frame(data, self.position)
+        complete = len(starts)
+        if complete:
+            self.file.write((self.position + 4 * starts).astype('<u8').tobytes())
+            self.event_count += complete
+        consumed = 4 * int(ends[complete - 1]) if complete else 0
+        self.carry = bytes(data[consumed:])
+        self.position += consumed
+
+    def close(self):
+        if not self.failed:
+            # the size of the data indexed, to tell a complete index from a stale one
+            self.file.seek(EventIndex.HEADER.size - EventIndex.DATA_SIZE.size)
+            self.file.write(EventIndex.DATA_SIZE.pack(self.position + len(self.carry)))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class IndexedFile:
+    """Data file opened for writing whose event index is written alongside.
+
+    An error while indexing is logged and stops the index, not the
+    recording; the index is then rebuilt (or the error reported) when the
+    file is opened with EventIndex.open().
+    """
+    def __init__(self, data_filename, new_format, decoded=True, metadata=None):
+        self.name = data_filename
+        self.file = open(data_filename, 'wb')
+        self.index = EventIndexWriter(data_filename, new_format, decoded, metadata)
+
+    def write(self, data):
+        n = self.file.write(data)
+        if not self.index.failed:
+            try:
+                self.index.add(data)
+            except ValueError as e:
+                self.index.failed = True
+                logger.warning(f"{self.name}: {e}, event index not written further")
+        return n
+
+    def flush(self):
+        self.file.flush()
+        self.index.file.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <data file>')
+    parser.add_option('-r', '--rebuild', dest='rebuild', action='store_true', help='rebuild the index from the data file')
+    parser.add_option('-e', '--event', dest='event', type='int', default=None, help='print event N')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    start = time.monotonic()
+    index = EventIndex.rebuild(args[0]) if options.rebuild else EventIndex.open(args[0])
+    print(f"{args[0]}: {len(index)} events, {'new' if index.new_format else 'legacy'} format"
+          f"{', raw' if not index.new_format and not index.decoded else ''} ({time.monotonic() - start:.3f} s)")
+    for key, value in index.metadata.items():
+        print(f"  {key}: {value}")
+    if options.event is not None:
+        words, starts, ends = index.read_events(options.event)
+        print(f"event {options.event} at byte {index.event_range(options.event)[0]}: header 0x{int(words[0]):08X}")
+        print(" ".join(f"{int(word):08X}" for word in words[1:ends[0]]))
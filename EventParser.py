@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import optparse
+import numpy as np
+
+class EventParser:
+    """Split a block of the event stream into events, vectorized.
+
+    parse() decodes every complete word of the block at once, locates the
+    header words (0xFF7C in the new format, bit 27 in the legacy format)
+    and checks that they chain through the data sizes. It returns the
+    decoded words and the word offsets of the complete events; the bytes
+    of a trailing partial event are left for the caller to carry over.
+    """
+    # One event is at most a header and 0x0FFF data words
+    MAX_EVENT_BYTES = 4 * (1 + 0x0FFF)
+
+    def __init__(self, new_format, decoded=False):
+        self.new_format = new_format
+        self.decoded = decoded  # legacy words already unpacked, as in the files written by 'read'
+
+    @staticmethod
+    def detect(word):
+        """Return (new_format, decoded) for a stream whose first word is `word`."""
+        if (word & 0xFFFF0000) == 0xFF7C0000:
+            return True, False
+        if (word & 0x80808080) == 0x80000000 and word & 0x40000000:  # bit 27 after unpacking
+            return False, False
+        if (word & 0xF0000000) == 0 and word & 0x08000000:
+            return False, True
+        raise ValueError(f"0x{word:08X} is not an event header")
+
+    def decode(self, words):
+        """Check the frame bits of a uint32 array and return the decoded words (decoded in place)."""
+        if self.new_format:
+            if np.any((words & 0xC0000000) != 0xC0000000):
+                raise ValueError("Frame Error 1")
+            return words
+        elif self.decoded:
+            if np.any(words & 0xF0000000):
+                raise ValueError("Frame Error 2")
+            return words
+        else:
+            words, frame_errors = self.unpack_legacy(words)
+            if np.any(frame_errors):
+                raise ValueError("Frame Error 2")
+            return words
+
+    @staticmethod
+    def unpack_legacy(words):
+        """Unpack legacy 7-bit-packed words in place; return them and the frame-error mask.
+
+        The four 7-bit groups are folded pairwise, 7+7 bits into 14 and
+        14+14 into 28, which takes half the shifts and temporaries of
+        extracting each group.
+        """
+        scratch = words & 0x80808080
+        frame_errors = scratch != 0x80000000
+        words &= 0x7F7F7F7F
+        np.right_shift(words, 1, out=scratch)
+        scratch &= 0x3F803F80
+        words &= 0x007F007F
+        words |= scratch
+        np.right_shift(words, 2, out=scratch)
+        scratch &= 0x0FFFC000
+        words &= 0x00003FFF
+        words |= scratch
+        return words, frame_errors
+
+    @classmethod
+    def decode_legacy_buffer(cls, data):
+        """Decode a raw legacy byte buffer; return the words and the frame-error mask, never raising."""
+        words = np.frombuffer(data, dtype='>u4', count=len(data) // 4).astype(np.uint32)
+        return cls.unpack_legacy(words)
+
+    def is_header(self, words):
+        if self.new_format:
+            return (words & 0xFFFF0000) == 0xFF7C0000
+        return (words & 0x08000000) != 0
+
+    def is_stored_header(self, words):
+        """is_header() for words as stored, i.e. still 7-bit packed unless decoded or in the new format."""
+        if self.new_format or self.decoded:
+            return self.is_header(words)
+        return (words & 0x40000000) != 0  # bit 27 of the decoded word is bit 30 of the packed one
+
+    def frame(self, data, position=0):
+        """Return the word offsets (starts, ends) of the complete events at the start of stored `data`.
+
+        Only the headers are looked at, so a corrupt data word does not stop
+        a writer that stores the words as they are. Errors name the byte
+        offset of the break, counted from `position`.
+        """
+        words = np.frombuffer(data, dtype='>u4', count=len(data) // 4)
+        starts = np.flatnonzero(self.is_stored_header(words))
+        if len(words) and (len(starts) == 0 or starts[0] != 0):
+            raise ValueError(f"Frame Error 3 at byte {position}")
+        headers = words[starts].astype(np.uint32)
+        if not (self.new_format or self.decoded):
+            headers, _ = self.unpack_legacy(headers)
+        ends = starts + 1 + (headers & 0x0FFF).astype(np.int64)
+        broken = np.flatnonzero(ends[:-1] != starts[1:])
+        if len(broken):
+            i = broken[0]
+            error = "Frame Error 5" if ends[i] > starts[i + 1] else "Frame Error 3"
+            raise ValueError(f"{error} at byte {position + 4 * int(starts[i])}")
+        complete = np.searchsorted(ends, len(words), side='right')
+        return starts[:complete], ends[:complete]
+
+    def parse(self, data, limit=None):
+        """Parse the complete events at the start of `data` (a bytes-like object).
+
+        Returns (words, starts, ends, consumed): the decoded words, the word
+        offsets of each event's header and of its end, and the number of
+        bytes used, at most `limit` events.
+        """
+        n_words = len(data) // 4
+        words = self.decode(np.frombuffer(data, dtype='>u4', count=n_words).astype(np.uint32))
+        starts = np.flatnonzero(self.is_header(words))
+        if n_words and (len(starts) == 0 or starts[0] != 0):
+            raise ValueError("Frame Error 3")
+        ends = starts + 1 + (words[starts] & 0x0FFF).astype(np.int64)
+
+        # every event must end where the next header starts
+        broken = np.flatnonzero(ends[:-1] != starts[1:])
+        if len(broken):
+            i = broken[0]
+            # a header flag inside the data, or no header where the next event should start
+            raise ValueError("Frame Error 5" if ends[i] > starts[i + 1] else "Frame Error 3")
+
+        complete = np.searchsorted(ends, n_words, side='right')
+        if limit is not None:
+            complete = min(complete, limit)
+        starts, ends = starts[:complete], ends[:complete]
+        consumed = 4 * int(ends[-1]) if complete else 0
+        return words, starts, ends, consumed
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <raw legacy file>')
+    parser.add_option('-o', '--output', dest='output', default=None, help='write the decoded words (big-endian) to this file')
+    parser.add_option('-c', '--chunk', dest='chunk', type='int', default=16, help='chunk size in MiB')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    # Decode a stream recorded with 'read ... raw' in the legacy format into the layout of 'read'
+    chunk_size = options.chunk << 20
+    total = 0
+    error_count = 0
+    start = time.monotonic()
+    with open(args[0], 'rb') as file, (open(options.output, 'wb') if options.output else open(os.devnull, 'wb')) as output:
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                break
+            words, frame_errors = EventParser.decode_legacy_buffer(data)
+            bad = np.flatnonzero(frame_errors)
+            if len(bad):
+                if error_count == 0:
+                    print(f"First frame error at byte {total + 4 * bad[0]}")
+                error_count += len(bad)
+            output.write(words.astype('>u4').tobytes())
+            total += len(data)
+    elapsed = time.monotonic() - start
+    print(f"{total // 4} words, {error_count} frame errors, {total / 1e6 / max(elapsed, 1e-9):.0f} MB/s")
@@ -0,0 +1,317 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+def unique_filename(filename):
+    """Return `filename`, or a name with the current time appended if that file already exists."""
+    if os.path.exists(filename):
+        print(f"{filename} already exists.")
+        root, suffix = os.path.splitext(filename)
+        filename = f"{root}_{int(time.time())}{suffix}"
+    return filename
+
+
+class EventRing:
+    """Bounded ring of preallocated buffers between a receiver and a writer.
+
+    put() appends to the slot being filled and hands it over once the next
+    piece does not fit, or once `flush_interval` seconds have passed since
+    the last hand-over so that a low trigger rate does not hold data back.
+    When every slot is waiting to be written, put() blocks (backpressure)
+    and the stall is counted. The writer takes the oldest filled slot with
+    get() and gives it back with release().
+    """
+    def __init__(self, slots=64, slot_size=1 << 20, flush_interval=0.5):
+        self.slot_size = slot_size
+        self.flush_interval = flush_interval
+        self.buffers = [bytearray(slot_size) for _ in range(slots)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.lengths = [0] * slots
+        self.event_counts = [0] * slots
+        self.boundaries = [False] * slots  # slot ends a subrun
+        self.head = 0  # slot being filled
+        self.tail = 0  # oldest filled slot
+        self.filled = 0
+        self.closed = False
+        self.aborted = False
+        self.condition = threading.Condition()
+        self.commit_time = time.monotonic()
+
+        self.high_water = 0
+        self.occupancy_sum = 0
+        self.commit_count = 0
+        self.stall_count = 0
+        self.stall_time = 0.0
+        self.byte_count = 0
+        self.event_count = 0
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def put(self, data, events=0, boundary=False):
+        """Copy `data` (with the number of events it completes) into the ring.
+
+        With boundary=True the slot is handed over right away and the
+        writer is told that a subrun ends after it. An empty `data` only
+        hands over what is due by `flush_interval`.
+        """
+        data = memoryview(data).cast('B')
+        if self.lengths[self.head] + len(data) > self.slot_size:
+            self.commit()
+        # a piece larger than a slot is spread over consecutive slots, its events counted in the last
+        while len(data) > self.slot_size:
+            self.views[self.head][:] = data[:self.slot_size]
+            self.lengths[self.head] = self.slot_size
+            data = data[self.slot_size:]
+            self.commit()
+        size = len(data)
+        start = self.lengths[self.head]
+        self.views[self.head][start:start + size] = data
+        self.lengths[self.head] = start + size
+        self.event_counts[self.head] += events
+        if boundary:
+            self.boundaries[self.head] = True
+            self.commit()
+        elif self.flush_interval is not None and time.monotonic() - self.commit_time >= self.flush_interval:
+            self.commit()
+
+    def commit(self):
+        """Hand the slot being filled to the writer, waiting for a free slot if necessary."""
+        if self.lengths[self.head] == 0 and not self.boundaries[self.head]:
+            return
+        with self.condition:
+            # one slot always stays with the receiver
+            if self.filled + 1 >= len(self.buffers) and not self.aborted:
+                self.stall_count += 1
+                start = time.monotonic()
+                while self.filled + 1 >= len(self.buffers) and not self.aborted:
+                    self.condition.wait()
+                self.stall_time += time.monotonic() - start
+            if self.aborted:
+                raise RuntimeError("Writer stopped")
+            self.filled += 1
+            self.high_water = max(self.high_water, self.filled)
+            self.occupancy_sum += self.filled
+            self.commit_count += 1
+            self.byte_count += self.lengths[self.head]
+            self.event_count += self.event_counts[self.head]
+            self.head = (self.head + 1) % len(self.buffers)
+            self.commit_time = time.monotonic()
+            self.condition.notify_all()
+
+    def close(self):
+        """Commit the last partial slot and let the writer finish."""
+        self.commit()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    def get(self):
+        """Return (data, events, boundary) of the oldest filled slot, or None once the ring is closed and empty or aborted."""
+        with self.condition:
+            while self.filled == 0 and not self.closed and not self.aborted:
+                self.condition.wait()
+            if self.filled == 0 or self.aborted:
+                return None
+        return self.views[self.tail][:self.lengths[self.tail]], self.event_counts[self.tail], self.boundaries[self.tail]
+
+    def release(self):
+        """Give the slot returned by get() back to the receiver."""
+        with self.condition:
+            self.lengths[self.tail] = 0
+            self.event_counts[self.tail] = 0
+            self.boundaries[self.tail] = False
+            self.tail = (self.tail + 1) % len(self.buffers)
+            self.filled -= 1
+            self.condition.notify_all()
+
+    def statistics(self):
+        return {
+            'slots': len(self.buffers),
+            'slot_size': self.slot_size,
+            'high_water': self.high_water,
+            'mean_occupancy': self.occupancy_sum / self.commit_count if self.commit_count else 0.0,
+            'stall_count': self.stall_count,
+            'stall_time': self.stall_time,
+            'bytes': self.byte_count,
+            'events': self.event_count,
+        }
+
+
+class EventPipeline:
+    """Receive on one thread and write to disk on another, through an EventRing.
+
+    `source` is an iterable of (data, events) pairs, e.g. the chunks of
+    VmeEasiroc.read_raw(). It is consumed on the receiver thread, so a slow
+    disk only fills the ring instead of stalling the socket. A source may
+    also yield (data, events, boundary) to end a subrun after `data`; the
+    writer then calls file.rotate() (see SubrunFiles).
+
+    If the source fails, what it delivered before is still written before
+    the error is raised; if the writer fails, the receiver stops at once.
+    """
+    def __init__(self, source, file, slots=64, slot_size=1 << 20, progress=None, flush_interval=0.5):
+        self.source = source
+        self.file = file
+        self.ring = EventRing(slots, slot_size, flush_interval)
+        self.progress = progress  # called with the number of events written
+        self.error = None
+
+    def run(self):
+        writer = threading.Thread(target=self.write, daemon=True)
+        writer.start()
+        try:
+            for item in self.source:
+                self.ring.put(*item)
+        except BaseException as e:
+            # A writer failure surfaces as its own error, not as the receiver's RuntimeError
+            if self.error is None:
+                self.error = e
+        finally:
+            if self.error is not None:
+                close = getattr(self.source, 'close', None)
+                if close is not None:
+                    close()  # leave DAQ mode and close the socket
+            try:
+                self.ring.close()  # the writer drains the filled slots, also after a receiver error
+            except RuntimeError:
+                pass  # the writer stopped
+            writer.join()
+        if self.error is not None:
+            raise self.error
+        return self.ring.statistics()
+
+    def write(self):
+        try:
+            while True:
+                item = self.ring.get()
+                if item is None:
+                    return
+                data, events, boundary = item
+                self.file.write(data)
+                self.ring.release()
+                if boundary:
+                    self.file.rotate()
+                if self.progress is not None and events:
+                    self.progress(events)
+        except BaseException as e:
+            self.error = e
+            self.ring.abort()
+
+    @staticmethod
+    def format(statistics):
+        return (f"ring high water {statistics['high_water']}/{statistics['slots']} slots, "
+                f"mean occupancy {statistics['mean_occupancy']:.1f}, "
+                f"{statistics['stall_count']} stalls ({statistics['stall_time']:.3f} s), "
+                f"{statistics['bytes'] / 1e6:.1f} MB")
+
+
+class SubrunSplitter:
+    """Cut a stream of whole-event blocks into subruns of a number of events, bytes or seconds.
+
+    split() takes a block of decoded header and data words and the end
+    offset of every event in it, and cuts it at the event boundaries where
+    a subrun is full. Time is checked once per block; a block without
+    events can be passed to end a subrun on time while no data comes in.
+    """
+    def __init__(self, max_events=None, max_bytes=None, max_seconds=None):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.subrun_count = 0
+        self.reset()
+
+    def reset(self):
+        self.event_count = 0
+        self.byte_count = 0
+        self.start_time = None  # set by the first event of the subrun
+
+    def split(self, words, ends):
+        """Yield (words, events, last) pieces of the block; last is True when the piece completes a subrun."""
+        begin = 0
+        word_begin = 0
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        if len(ends) == 0:
+            if self.max_seconds is not None and time.monotonic() - self.start_time >= self.max_seconds:
+                yield words[:0], 0, True
+                self.subrun_count += 1
+                self.reset()
+            return
+        while begin < len(ends):
+            cut = len(ends)
+            full = False
+            if self.max_events is not None:
+                cut = min(cut, begin + self.max_events - self.event_count)
+            if self.max_bytes is not None:
+                room = (self.max_bytes - self.byte_count) // 4
+                fits = max(int(np.searchsorted(ends, word_begin + room, side='right')), begin + 1)
+                if fits < cut:
+                    cut = fits
+                    full = True  # the next event does not fit any more
+            word_end = int(ends[cut - 1])
+            self.event_count += cut - begin
+            self.byte_count += 4 * (word_end - word_begin)
+            if self.max_events is not None and self.event_count >= self.max_events:
+                full = True
+            if self.max_bytes is not None and self.byte_count >= self.max_bytes:
+                full = True
+            if self.max_seconds is not None and time.monotonic() - self.start_time >= self.max_seconds:
+                full = True
+            yield words[word_begin:word_end], cut - begin, full
+            if full:
+                self.subrun_count += 1
+                self.reset()
+            begin, word_begin = cut, word_end
+
+
+class SubrunFiles:
+    """Write-only file that moves on to the next file of a numbered series on rotate().
+
+    `pattern` is formatted with the subrun index, e.g. 'data/run_{index}.dat';
+    existing files are not overwritten. `opener(filename)` opens each file,
+    e.g. to write an IndexedFile.
+    """
+    def __init__(self, pattern, first_index=0, opener=None):
+        self.pattern = pattern
+        self.index = first_index
+        self.opener = opener or (lambda filename: open(filename, 'wb'))
+        self.file = None
+        self.filenames = []
+
+    def open(self):
+        filename = unique_filename(self.pattern.format(index=self.index))
+        print(f"Save as {filename}")
+        self.file = self.opener(filename)
+        self.filenames.append(filename)
+
+    def write(self, data):
+        if self.file is None:
+            self.open()
+        return self.file.write(data)
+
+    def rotate(self):
+        """Close the current file; the next write opens the following one."""
+        if self.file is None:
+            self.open()  # an empty subrun still gets its file
+        self.file.close()
+        self.file = None
+        self.index += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,121 @@
+import queue
+import threading
+import numpy as np
+
+class HistogramEngine:
+    """HG, LG and TDC histograms of all 64 channels, filled while the data comes in.
+
+    All histograms are rows of one preallocated 2-D array: row
+    kind * 64 + channel, kind as in KINDS, with `bins` fixed bins over the
+    12-bit value. A batch of data words is classified with the bits that
+    VmeEasiroc.hg(), lg() and tdc() test and added in one step, with
+    np.add.at for small batches and np.bincount over the whole array for
+    large ones.
+
+    submit() hands a batch to a filling thread through a bounded queue and
+    never blocks: when the filler falls behind, the batch is dropped and
+    counted, so monitoring cannot slow the readout down. snapshot() copies
+    the histograms under the lock from any thread while the DAQ goes on.
+    """
+    KINDS = ('HG', 'LG', 'TDC leading', 'TDC trailing')
+    CHANNELS = 64
+
+    def __init__(self, bins=4096, queue_size=64):
+        if bins & (bins - 1) or not 1 <= bins <= 4096:
+            raise ValueError("bins must be a power of two up to 4096")
+        self.bins = bins
+        self.shift = 12 - (bins.bit_length() - 1)
+        self.counts = np.zeros((len(self.KINDS) * self.CHANNELS, bins), dtype=np.int64)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts[:] = 0
+            self.event_count = 0
+            self.word_count = 0
+            self.dropped_count = 0
+
+    def fill(self, words, events=0, starts=None):
+        """Add a batch of decoded words; the words at `starts` (event headers) are skipped."""
+        words = np.asarray(words, dtype=np.uint32)
+        if starts is not None:
+            is_data = np.ones(len(words), dtype=bool)
+            is_data[starts] = False
+            words = words[is_data]
+            events = len(starts)
+        kind = ((words >> 20) & 2) | ((words >> 19) & 1)  # 2 * tdc + (LG or trailing)
+        row = kind.astype(np.int64) * self.CHANNELS + ((words >> 13) & 0x3F)
+        index = row * self.bins + ((words & 0x0FFF) >> self.shift)
+        with self.lock:
+            if len(index) * 32 < self.counts.size:
+                np.add.at(self.counts.ravel(), index, 1)
+            else:
+                self.counts += np.bincount(index, minlength=self.counts.size).reshape(self.counts.shape)
+            self.event_count += events
+            self.word_count += len(words)
+
+    def submit(self, words, events=0, starts=None):
+        """Fill from the filling thread if it runs (dropping the batch if it lags), else right away."""
+        if self.thread is None:
+            self.fill(words, events, starts)
+            return
+        try:
+            self.queue.put_nowait((words, events, starts))
+        except queue.Full:
+            with self.lock:
+                self.dropped_count += 1
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Fill what is queued and stop the filling thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            self.fill(*batch)
+
+    def snapshot(self):
+        """Return a copy of the histograms as a (kind, channel, bin) array and the statistics."""
+        with self.lock:
+            counts = self.counts.copy()
+            statistics = self.statistics_locked()
+        return counts.reshape(len(self.KINDS), self.CHANNELS, self.bins), statistics
+
+    def statistics(self):
+        with self.lock:
+            return self.statistics_locked()
+
+    def statistics_locked(self):
+        return {'events': self.event_count, 'words': self.word_count, 'dropped_batches': self.dropped_count}
+
+    def bin_centers(self):
+        width = 1 << self.shift
+        return np.arange(self.bins) * width + (width - 1) / 2
+
+    def summary(self, counts):
+        """Return the entries, mean and RMS of every histogram of a snapshot, each shaped (kind, channel)."""
+        centers = self.bin_centers()
+        entries = counts.sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (counts * centers).sum(axis=-1) / entries
+            rms = np.sqrt(np.maximum((counts * centers ** 2).sum(axis=-1) / entries - mean ** 2, 0))
+        return entries, mean, rms
+
+    def save(self, filename):
+        """Write a snapshot to an .npz file (counts, kinds, bin edges and statistics)."""
+        counts, statistics = self.snapshot()
+        np.savez(filename, counts=counts, kinds=np.array(self.KINDS),
+                 edges=np.arange(self.bins + 1) << self.shift, **statistics)
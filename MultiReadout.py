@@ -0,0 +1,202 @@
+import contextlib
+import os
+import selectors
+import socket
+import time
+
+from EventIndex import IndexedFile
+from EventParser import EventParser
+from EventPipeline import SubrunFiles, SubrunSplitter, unique_filename
+
+class ModuleStream:
+    """Receive state of one module in a MultiReadout."""
+    def __init__(self, name, vme_easiroc, writer, number_to_read, chunk_size, splitter=None, monitor=None,
+                 builder=None):
+        self.name = name
+        self.vme_easiroc = vme_easiroc
+        self.writer = writer
+        self.splitter = splitter  # cuts the output into subruns, the writer must have rotate()
+        self.monitor = monitor  # e.g. a HistogramEngine, given the events of every chunk
+        self.builder = builder  # called with (name, words, starts, ends) of every chunk
+        self.remaining = number_to_read
+        self.parser = EventParser(vme_easiroc.new_format)
+        self.buffer = bytearray(chunk_size + EventParser.MAX_EVENT_BYTES)
+        self.view = memoryview(self.buffer)
+        self.chunk_size = chunk_size
+        self.filled = 0
+
+        self.event_count = 0
+        self.byte_count = 0
+        self.recv_count = 0
+        self.start_time = None
+        self.stop_time = None
+
+    def service(self):
+        """Receive one chunk and write the complete events it finishes; return False once done."""
+        n = self.vme_easiroc.sock.recv_into(self.view[self.filled:self.filled + self.chunk_size])
+        if n == 0:
+            raise ConnectionError(f"{self.name}: connection closed before receiving all data")
+        self.recv_count += 1
+        self.byte_count += n
+        self.filled += n
+        words, starts, ends, consumed = self.parser.parse(self.view[:self.filled], self.remaining)
+        if len(starts):
+            # header and data words are contiguous, write them as the 'read' command does
+            if self.monitor is not None:
+                self.monitor.submit(words[:ends[-1]], starts=starts)
+            if self.builder is not None:
+                self.builder(self.name, words, starts, ends)
+            block = words[:ends[-1]].astype('>u4')
+            if self.splitter is None:
+                self.writer.write(block)
+            else:
+                for piece, _, last in self.splitter.split(block, ends):
+                    self.writer.write(piece)
+                    if last:
+                        self.writer.rotate()
+            self.remaining -= len(starts)
+            self.event_count += len(starts)
+        self.buffer[:self.filled - consumed] = self.buffer[consumed:self.filled]
+        self.filled -= consumed
+        return self.remaining > 0
+
+    def statistics(self):
+        elapsed = ((self.stop_time or time.monotonic()) - self.start_time) if self.start_time else 0.0
+        return {
+            'events': self.event_count,
+            'bytes': self.byte_count,
+            'recv_count': self.recv_count,
+            'elapsed': elapsed,
+            'rate': self.event_count / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class MultiReadout:
+    """Read several VME-EASIROC modules from one selector loop.
+
+    The driver owns the TCP connections of all modules. Each pass over the
+    readable sockets receives at most one chunk per module, so a busy
+    module cannot starve the others. The complete events of every chunk
+    are written to that module's writer in the layout of the 'read'
+    command (decoded header and data words, big-endian). With an
+    EventBuilder, the fragments of the modules are also merged into
+    built events as they come in.
+    """
+    def __init__(self, modules, chunk_size=1 << 18):
+        self.modules = modules  # name -> VmeEasiroc
+        self.chunk_size = chunk_size
+        self.streams = {}
+        self.monitors = {}  # name -> HistogramEngine filled during read()
+        self.builder = None
+        self.built_writer = None
+        self.stop_requested = False
+
+    def stop(self):
+        """Ask a running read() to finish after the current pass (thread safe)."""
+        self.stop_requested = True
+
+    def read(self, number_to_read, writers, splitters=None, builder=None, built_writer=None):
+        """Read `number_to_read` events from every module into writers[name]; return the statistics.
+
+        With splitters[name] (SubrunSplitter) the output of a module is cut
+        into subruns, rotating writers[name] (e.g. SubrunFiles) in between.
+        With an EventBuilder whose sources are the module names, the built
+        events are written to `built_writer` (see EventBuilder.words()).
+        """
+        if builder is not None and set(builder.sources) != set(self.modules):
+            raise ValueError(f"EventBuilder sources {builder.sources} are not the modules {tuple(self.modules)}")
+        self.stop_requested = False
+        splitters = splitters or {}
+        self.builder, self.built_writer = builder, built_writer
+        self.streams = {name: ModuleStream(name, vme_easiroc, writers[name], number_to_read, self.chunk_size,
+                                           splitters.get(name), self.monitors.get(name),
+                                           None if builder is None else self.build)
+                        for name, vme_easiroc in self.modules.items()}
+        with selectors.DefaultSelector() as selector, contextlib.ExitStack() as stack:
+            for monitor in self.monitors.values():
+                monitor.start()
+                stack.callback(monitor.stop)
+            for stream in self.streams.values():
+                vme_easiroc = stream.vme_easiroc
+                vme_easiroc.sock = socket.create_connection((vme_easiroc.host, vme_easiroc.tcp_port))
+                stack.callback(self.close, vme_easiroc)
+                vme_easiroc.read_and_throw_previous_data()
+                vme_easiroc.sock.setblocking(False)
+                selector.register(vme_easiroc.sock, selectors.EVENT_READ, stream)
+            for stream in self.streams.values():
+                stack.enter_context(stream.vme_easiroc.enter_daq_mode())
+                stream.start_time = time.monotonic()
+
+            active = len(self.streams)
+            while active and not self.stop_requested:
+                for key, _ in selector.select(timeout=0.1):
+                    stream = key.data
+                    try:
+                        more = stream.service()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    if not more:
+                        stream.stop_time = time.monotonic()
+                        selector.unregister(key.fileobj)
+                        active -= 1
+            for stream in self.streams.values():
+                if stream.stop_time is None:
+                    stream.stop_time = time.monotonic()
+        if builder is not None:
+            builder.flush()
+        return self.statistics()
+
+    def build(self, name, words, starts, ends):
+        """Give the events of a chunk of module `name` to the EventBuilder and write the built ones."""
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            event = self.builder.add(name, int(words[start]), words[start + 1:end])
+            if event is not None and self.built_writer is not None:
+                self.built_writer.write(self.builder.words(event[1]))
+
+    @staticmethod
+    def close(vme_easiroc):
+        vme_easiroc.sock.setblocking(True)
+        vme_easiroc.read_and_throw_previous_data()
+        vme_easiroc.sock.close()
+        vme_easiroc.sock = None
+
+    def statistics(self):
+        return {name: stream.statistics() for name, stream in self.streams.items()}
+
+    @staticmethod
+    def format(statistics):
+        return "\n".join(f"{name}: {s['events']} events, {s['bytes'] / 1e6:.1f} MB in {s['elapsed']:.2f} s "
+                         f"({s['rate']:.0f} events/s, {s['recv_count']} recv calls)"
+                         for name, s in statistics.items())
+
+    def opener(self, name):
+        """Return a function opening an IndexedFile for the data of module `name`."""
+        vme_easiroc = self.modules[name]
+        metadata = dict(vme_easiroc.run_metadata(), module=name)
+        return lambda filename: IndexedFile(filename, vme_easiroc.new_format, True, metadata)
+
+    def record_subruns(self, events_per_subrun, subruns, basename):
+        """Read `subruns` subruns of `events_per_subrun` events without leaving DAQ mode.
+
+        Module `name` writes data/<basename>_<name>_<subrun>.dat.
+        """
+        if not os.path.exists('data'):
+            os.makedirs('data')
+        with contextlib.ExitStack() as stack:
+            writers = {name: stack.enter_context(SubrunFiles(f'data/{basename}_{name}_{{index}}.dat',
+                                                             opener=self.opener(name)))
+                       for name in self.modules}
+            splitters = {name: SubrunSplitter(max_events=events_per_subrun) for name in self.modules}
+            return self.read(events_per_subrun * subruns, writers, splitters)
+
+    def record(self, number_to_read, filenames):
+        """Read into data files, one per module; existing files are not overwritten."""
+        if not os.path.exists('data'):
+            os.makedirs('data')
+        with contextlib.ExitStack() as stack:
+            writers = {}
+            for name, filename in filenames.items():
+                data_filename = unique_filename(f'data/{filename}')
+                print(f"Save as {data_filename} {number_to_read} events")
+                writers[name] = stack.enter_context(self.opener(name)(data_filename))
+            return self.read(number_to_read, writers)
@@ -0,0 +1,160 @@
+import os
+import sys
+import mmap
+import time
+import optparse
+import multiprocessing
+import numpy as np
+
+from ColumnConverter import ColumnConverter
+from EventIndex import EventIndex
+from EventParser import EventParser
+
+def parse_blocks(task, chunk_bytes):
+    """Yield (words, starts) of the blocks of events of a task, decoded and checked by EventParser.
+
+    Returns the number of bytes of an incomplete event at the end of the task.
+    """
+    filename, new_format, decoded, word_begin, word_end, _ = task
+    parser = EventParser(new_format, decoded)
+    with open(filename, 'rb') as file:
+        # not closed explicitly: an error leaves views of it in the traceback
+        view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))[4 * word_begin:4 * word_end]
+    position = 0
+    while position < len(view):
+        try:
+            words, starts, ends, consumed = parser.parse(view[position:position + chunk_bytes])
+        except ValueError as e:
+            raise ValueError(f"{filename}: {e} in the events from byte {4 * word_begin + position}") from None
+        if consumed == 0:
+            return len(view) - position  # e.g. a run that was cut short
+        yield words[:ends[-1]], starts
+        position += consumed
+    return 0
+
+def count_task(task, chunk_bytes):
+    """Return the (events, ADC words, TDC words, incomplete bytes) of a task."""
+    events = adc_count = tdc_count = 0
+    blocks = parse_blocks(task, chunk_bytes)
+    while True:
+        try:
+            words, starts = next(blocks)
+        except StopIteration as stop:
+            return events, adc_count, tdc_count, stop.value
+        adc, tdc = ColumnConverter.count_block(words, starts)
+        events += len(starts)
+        adc_count += adc
+        tdc_count += tdc
+
+def fill_task(task, chunk_bytes, directory, adc_position, tdc_position):
+    columns = ColumnConverter.load(directory, mmap_mode='r+')
+    adc = {name: columns[f'adc_{name}'] for name in ColumnConverter.ADC_COLUMNS}
+    tdc = {name: columns[f'tdc_{name}'] for name in ColumnConverter.TDC_COLUMNS}
+    first_event = task[-1]
+    for words, starts in parse_blocks(task, chunk_bytes):
+        adc_n, tdc_n = ColumnConverter.fill_block(adc, tdc, words, starts, first_event, adc_position, tdc_position)
+        adc_position += adc_n
+        tdc_position += tdc_n
+        first_event += len(starts)
+    for column in columns.values():
+        column.flush()
+
+
+class ParallelDecoder:
+    """Decode and classify data files into ColumnConverter columns with a process pool.
+
+    A file is split into tasks of about equal size at event headers, taken
+    from the .idx file when there is one. Otherwise the first header after
+    each split point is looked up in a window of one maximum event size:
+    header words cannot occur inside the data (bits 24-29 are clear in
+    new-format data words, bit 27 in legacy ones), and every worker checks
+    that the headers of its task chain up to the next task.
+
+    Each worker maps the file itself, so no event data goes through the
+    pool. A first round counts the events, ADC and TDC words of every
+    task; their prefix sums give each task the first event number and the
+    rows it owns, and a second round writes the rows straight into the
+    memory-mapped columns, which are thus in event order without a merge.
+    """
+    def __init__(self, processes=None, tasks_per_process=4, chunk_bytes=1 << 20):
+        self.processes = processes or os.cpu_count()
+        self.tasks_per_process = tasks_per_process  # smaller tasks even out the load
+        self.chunk_bytes = max(chunk_bytes, EventParser.MAX_EVENT_BYTES)
+
+    def plan(self, filename):
+        """Return the tasks (filename, new_format, decoded, word_begin, word_end, None) of a file."""
+        n_words = os.path.getsize(filename) // 4
+        if n_words == 0:
+            return []
+        targets = np.linspace(0, n_words, self.processes * self.tasks_per_process, endpoint=False).astype(np.int64)
+        try:
+            index = EventIndex.load(filename)
+            if index.stale:
+                raise ValueError(f"{filename}: stale event index")
+            new_format, decoded = index.new_format, index.decoded or index.new_format
+            starts = np.asarray(index.offsets, dtype=np.int64) // 4
+            firsts = np.unique(np.searchsorted(starts, targets))
+            bounds = starts[firsts[firsts < len(starts)]]
+            bounds = bounds[bounds < n_words] if len(bounds) else np.zeros(1, np.int64)
+        except (FileNotFoundError, ValueError):
+            with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                words = np.frombuffer(mapping, dtype='>u4', count=n_words)
+                new_format, decoded = EventParser.detect(int(words[0]))
+                decoded = decoded or new_format
+                parser = EventParser(new_format, decoded)
+                window = EventParser.MAX_EVENT_BYTES // 4 + 1  # always holds a header unless the file ends
+                bounds = []
+                for target in targets:
+                    found = np.flatnonzero(parser.is_stored_header(words[target:target + window]))
+                    if len(found):
+                        bounds.append(int(target + found[0]))
+                del words
+            bounds = np.unique(bounds)
+        bounds = np.append(bounds, n_words)
+        return [(filename, new_format, decoded, int(begin), int(end), None)
+                for begin, end in zip(bounds[:-1], bounds[1:])]
+
+    def convert(self, filename, directory, pool):
+        """Write the columns of `filename` to `directory`; return (events, ADC words, TDC words)."""
+        tasks = self.plan(filename)
+        counts = np.array(pool.starmap(count_task, [(task, self.chunk_bytes) for task in tasks]),
+                          dtype=np.int64).reshape(-1, 4)
+        incomplete = np.flatnonzero(counts[:-1, 3])
+        if len(incomplete):
+            raise ValueError(f"{filename}: Frame Error 3 before byte {4 * tasks[incomplete[0]][4]}")
+        if len(counts) and counts[-1, 3]:
+            print(f"{filename}: {counts[-1, 3]} bytes after the last complete event ignored")
+        first_event, adc_positions, tdc_positions = (np.concatenate(([0], np.cumsum(counts[:, i]))) for i in range(3))
+        tasks = [task[:-1] + (int(first),) for task, first in zip(tasks, first_event)]
+
+        adc, tdc = ColumnConverter.create_columns(directory, int(adc_positions[-1]), int(tdc_positions[-1]),
+                                                  int(first_event[-1]))
+        del adc, tdc  # the workers open the files themselves
+        pool.starmap(fill_task, [(task, self.chunk_bytes, directory, int(adc_position), int(tdc_position))
+                                 for task, adc_position, tdc_position in zip(tasks, adc_positions, tdc_positions)])
+        return int(first_event[-1]), int(adc_positions[-1]), int(tdc_positions[-1])
+
+    def run(self, filenames, output=None):
+        """Convert every file; with `output` the columns of a single file go there instead of <file>_columns."""
+        with multiprocessing.Pool(self.processes) as pool:
+            for filename in filenames:
+                directory = output or f"{os.path.splitext(filename)[0]}_columns"
+                start = time.monotonic()
+                events, adc_count, tdc_count = self.convert(filename, directory, pool)
+                elapsed = time.monotonic() - start
+                size = os.path.getsize(filename)
+                print(f"{filename}: {events} events, {adc_count} ADC and {tdc_count} TDC words to {directory}/ "
+                      f"in {elapsed:.2f} s ({size / 1e6 / max(elapsed, 1e-9):.0f} MB/s, {self.processes} processes)")
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <data file> ...')
+    parser.add_option('-j', '--processes', dest='processes', type='int', default=None,
+                      help='worker processes (default: number of CPUs)')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='output directory (default: <data file>_columns, one file only)')
+    (options, args) = parser.parse_args()
+    if not args or (options.output and len(args) > 1):
+        parser.print_help()
+        sys.exit(1)
+
+    ParallelDecoder(options.processes).run(args, options.output)
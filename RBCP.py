@@ -1,5 +1,14 @@
+import asyncio
+import bisect
+import logging
 import socket
 import struct
+import threading
+import time
+
+from RBCPTracer import RBCPTracer
+
+logger = logging.getLogger(__name__)
 
 class RBCPHeader:
     READ = 0xC0
@@ -32,45 +41,236 @@ class RBCPError(Exception):
     pass
 
 
+class RBCPLink:
+    """Round-trip time estimate, retry counters and circuit breaker of one board."""
+    def __init__(self, timeout=1.0, min_timeout=0.05, max_timeout=2.0,
+                 failure_threshold=3, probe_interval=5.0):
+        self.initial_timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.srtt = None
+        self.rttvar = None
+        self.transaction_count = 0
+        self.retry_count = 0
+        self.timeout_count = 0
+        self.failure_count = 0
+        self.rejected_count = 0
+        self.consecutive_failures = 0
+        self.opened_at = None  # time the circuit opened, None while closed
+        self.last_probe = 0.0
+
+    def timeout(self, attempt=0):
+        if self.srtt is None:
+            base = self.initial_timeout
+        else:
+            base = max(self.srtt + 4 * self.rttvar, self.min_timeout)
+        return min(base * (2 ** attempt), self.max_timeout)
+
+    def sample(self, rtt):
+        # Only replies to requests sent once are timed (Karn's algorithm)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def retry(self, timed_out):
+        self.retry_count += 1
+        if timed_out:
+            self.timeout_count += 1
+
+    def success(self):
+        self.transaction_count += 1
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.transaction_count += 1
+        self.failure_count += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold and self.opened_at is None:
+            self.opened_at = time.monotonic()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def probe_due(self):
+        now = time.monotonic()
+        if now - self.last_probe < self.probe_interval:
+            self.rejected_count += 1
+            return False
+        self.last_probe = now
+        return True
+
+    def statistics(self):
+        return {
+            'transactions': self.transaction_count,
+            'retries': self.retry_count,
+            'timeouts': self.timeout_count,
+            'failures': self.failure_count,
+            'rejected': self.rejected_count,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'timeout': self.timeout(),
+            'circuit_open': self.is_open(),
+        }
+
+
+class RBCPBatch:
+    """Merge writes into the fewest RBCP packets; not for writes whose order matters."""
+    def __init__(self, rbcp):
+        self.rbcp = rbcp
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.flush()
+
+    def write(self, address, data):
+        if isinstance(data, int):
+            data = [data]
+        if isinstance(data, list):
+            data = bytes(data)
+        if data:
+            self.writes.append((address, bytes(data)))
+
+    def write8bit(self, address, data):
+        self.write(address, data)
+
+    def write16bit(self, address, data):
+        if isinstance(data, int):
+            data = [data]
+        self.write(address, struct.pack('!{}H'.format(len(data)), *data))
+
+    def write32bit(self, address, data):
+        if isinstance(data, int):
+            data = [data]
+        self.write(address, struct.pack('!{}I'.format(len(data)), *data))
+
+    def regions(self):
+        spans = []
+        for address, data in sorted(self.writes, key=lambda w: w[0]):
+            end = address + len(data)
+            if spans and address <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([address, end])
+
+        starts = [start for start, _ in spans]
+        regions = [(start, bytearray(end - start)) for start, end in spans]
+        for address, data in self.writes:  # in call order so that later writes win
+            start, buffer = regions[bisect.bisect_right(starts, address) - 1]
+            buffer[address - start:address - start + len(data)] = data
+        return regions
+
+    def packets(self):
+        packets = []
+        for address, data in self.regions():
+            packets.extend(RBCP.write_packets(address, data))
+        return packets
+
+    def flush(self):
+        packets = self.packets()
+        self.writes = []
+        return self.rbcp.transact(packets)
+
+
 class RBCP:
-    def __init__(self, host, port):
+    PROBE_ADDRESS = 0xF0000000  # version register, read to probe a board behind an open circuit
+
+    def __init__(self, host, port, window=4, timeout=1.0, max_retries=3, link=None, tracer=None):
         self.host = host
         self.port = port
         self.id = 0
+        self.window = window        # number of transactions kept in flight
+        self.max_retries = max_retries
+        self.link = link or RBCPLink(timeout)
+        self.tracer = tracer        # RBCPTracer, None to disable tracing
+        self.sock = None
+        self.lock = threading.Lock()
 
-    def read(self, address, data_length):
-        read_data = bytearray()
+    @property
+    def retry_count(self):
+        return self.link.retry_count
+
+    @property
+    def timeout_count(self):
+        return self.link.timeout_count
+
+    def statistics(self):
+        return self.link.statistics()
+
+    def open(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('0.0.0.0', 0))
+            self.peer = (socket.gethostbyname(self.host), self.port)
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    @staticmethod
+    def read_packets(address, data_length):
+        packets = []
         while data_length > 0:
             data_length_one_packet = min(data_length, 255)
             dummy_data = b'\x00' * data_length_one_packet  # RBCP requires payload
-            read_data.extend(self.com(RBCPHeader.READ, address, data_length_one_packet, dummy_data))
+            packets.append((RBCPHeader.READ, address, data_length_one_packet, dummy_data))
             data_length -= data_length_one_packet
             address += data_length_one_packet
-        return read_data
-    
-    def read8bit(self, address, data_length):
-        return list(self.read(address, data_length))
-
-    def read16bit(self, address, data_length):
-        return list(struct.unpack('!{}H'.format(data_length), self.read(address, data_length * 2)))
-
-    def read32bit(self, address, data_length):
-        return list(struct.unpack('!{}I'.format(data_length), self.read(address, data_length * 4)))
+        return packets
 
-    def write(self, address, data):
+    @staticmethod
+    def write_packets(address, data):
         if isinstance(data, int):
             data = [data]
         if isinstance(data, list):
             data = bytes(data)
 
+        packets = []
         remaining_data_length = len(data)
         data_index = 0
         while remaining_data_length > 0:
             data_length_one_packet = min(remaining_data_length, 255)
-            data_to_write = data[data_index:data_index + data_length_one_packet]
-            self.com(RBCPHeader.WRITE, address + data_index, data_length_one_packet, data_to_write)
+            data_to_write = bytes(data[data_index:data_index + data_length_one_packet])
+            packets.append((RBCPHeader.WRITE, address + data_index, data_length_one_packet, data_to_write))
             remaining_data_length -= data_length_one_packet
             data_index += data_length_one_packet
+        return packets
+
+    def read(self, address, data_length):
+        read_data = bytearray()
+        for received_data in self.transact(self.read_packets(address, data_length)):
+            read_data.extend(received_data)
+        return read_data
+    
+    def read8bit(self, address, data_length):
+        return list(self.read(address, data_length))
+
+    def read16bit(self, address, data_length):
+        return list(struct.unpack('!{}H'.format(data_length), self.read(address, data_length * 2)))
+
+    def read32bit(self, address, data_length):
+        return list(struct.unpack('!{}I'.format(data_length), self.read(address, data_length * 4)))
+
+    def write(self, address, data):
+        self.transact(self.write_packets(address, data))
 
     def write8bit(self, address, data):
         self.write(address, data)
@@ -85,46 +285,114 @@ class RBCP:
             data = [data]
         self.write(address, struct.pack('!{}I'.format(len(data)), *data))
 
+    def batch(self):
+        return RBCPBatch(self)
+
     def com(self, rw, address, data_length, data):
-        retries = 0
-        max_retries = 3
-        while retries < max_retries:
+        return self.transact([(rw, address, data_length, data)])[0]
+
+    def transact(self, packets):
+        """Send (rw, address, data_length, data) packets, up to `window` in flight; return the replies in order."""
+        with self.lock:
+            if self.link.is_open():
+                if not self.link.probe_due():
+                    if self.tracer is not None and packets:
+                        self.tracer.record(self.host, *packets[0][:3], 0, 0.0, RBCPTracer.REJECTED)
+                    raise RBCPError(f"Circuit open: {self.host} is not answering")
+                try:
+                    self.exchange(self.read_packets(self.PROBE_ADDRESS, 1), 1)
+                except RBCPError:
+                    raise RBCPError(f"Circuit open: {self.host} did not answer the probe")
+            try:
+                replies = self.exchange(packets, self.max_retries)
+            except RBCPError:
+                self.link.failure()
+                raise
+            self.link.success()
+            return replies
+
+    def exchange(self, packets, max_attempts):
+        sock = self.open()
+        replies = [None] * len(packets)
+        in_flight = {}  # id -> [index, deadline, retries, sent_time]
+        next_index = 0
+        completed = 0
+        while completed < len(packets):
+            while next_index < len(packets) and len(in_flight) < self.window:
+                id_ = self.next_id(in_flight)
+                self.com_sub(sock, id_, *packets[next_index])
+                now = time.monotonic()
+                in_flight[id_] = [next_index, now + self.link.timeout(), 0, now]
+                next_index += 1
+
+            id_, deadline = min(((i, v[1]) for i, v in in_flight.items()), key=lambda x: x[1])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # settimeout(0) would make recvfrom non-blocking (BlockingIOError), not time out
+                self.retry(sock, id_, in_flight, packets, max_attempts, RBCPError("Timeout"), True)
+                continue
+            sock.settimeout(remaining)
             try:
-                return self.com_sub(rw, address, data_length, data)
+                received_data, peer = sock.recvfrom(255 + 8)
+            except socket.timeout:
+                self.retry(sock, id_, in_flight, packets, max_attempts, RBCPError("Timeout"), True)
+                continue
+
+            if peer != self.peer or len(received_data) < 8 or received_data[2] not in in_flight:
+                continue  # stale reply of a resent request or a stray packet
+            id_ = received_data[2]
+            index, _, retries, sent_time = in_flight[id_]
+            try:
+                self.validate(id_, *packets[index], received_data)
             except RBCPError as e:
-                print(e)
-                retries += 1
-        raise RBCPError("Communication failed after retries")
+                self.retry(sock, id_, in_flight, packets, max_attempts, e)
+                continue
+            latency = time.monotonic() - sent_time
+            if retries == 0:
+                self.link.sample(latency)
+            if self.tracer is not None:
+                self.tracer.record(self.host, *packets[index][:3], id_, latency, RBCPTracer.OK)
+            replies[index] = received_data[8:]
+            del in_flight[id_]
+            completed += 1
+        return replies
+
+    def next_id(self, in_flight):
+        while self.id in in_flight:
+            self.id = (self.id + 1) & 0xFF
+        id_ = self.id
+        self.id = (self.id + 1) & 0xFF
+        return id_
 
-    def com_sub(self, rw, address, data_length, data):
-        print(f"com_sub called: host={self.host}, rw={rw}, addr=0x{address:X}, len={data_length}, data={data.hex() if data else None}")
+    def retry(self, sock, id_, in_flight, packets, max_attempts, error, timed_out=False):
+        logger.debug(f"RBCP {self.host}: {error}")
+        entry = in_flight[id_]
+        if self.tracer is not None:
+            outcome = RBCPTracer.TIMEOUT if timed_out else RBCPTracer.ERROR
+            self.tracer.record(self.host, *packets[entry[0]][:3], id_, time.monotonic() - entry[3], outcome)
+        entry[2] += 1
+        if entry[2] >= max_attempts:
+            raise RBCPError("Communication failed after retries")
+        self.link.retry(timed_out)
+        self.com_sub(sock, id_, *packets[entry[0]])
+        entry[1] = time.monotonic() + self.link.timeout(entry[2])
+        entry[3] = time.monotonic()
 
+    def com_sub(self, sock, id_, rw, address, data_length, data):
         # Validate input types and values
         assert isinstance(address, int) and 0 <= address <= 0xFFFFFFFF, f"Invalid address: {address}"
         assert isinstance(data_length, int) and 0 < data_length <= 255, f"Invalid data_length: {data_length}"
         assert isinstance(data, (bytes, bytearray)), f"Data must be bytes or bytearray but got {type(data)}"
         assert len(data) == data_length, f"Data length {len(data)} does not match data_length {data_length}"
-    
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.bind(('0.0.0.0', 0))
-
-            header = RBCPHeader(rw, self.id, data_length, address)
-            data_to_be_sent = header.to_bytes() + data
 
-            if sock.sendto(data_to_be_sent, (self.host, self.port)) != len(data_to_be_sent):
-                raise RBCPError("Cannot send data")
-
-            sock.settimeout(1)
-            try:
-                received_data, _ = sock.recvfrom(255 + 8)
-            except socket.timeout:
-                raise RBCPError("Timeout")
+        header = RBCPHeader(rw, id_, data_length, address)
+        data_to_be_sent = header.to_bytes() + data
 
-            self.validate(rw, address, data_length, data, received_data)
-            self.id = (self.id + 1) & 0xFF
-            return received_data[8:]
+        if sock.sendto(data_to_be_sent, self.peer) != len(data_to_be_sent):
+            raise RBCPError("Cannot send data")
 
-    def validate(self, rw, address, data_length, data, received_data):
+    @staticmethod
+    def validate(id_, rw, address, data_length, data, received_data):
         header = RBCPHeader.from_bin(received_data)
         if received_data[0] != 0xFF:
             raise RBCPError("Invalid Ver Type")
@@ -133,7 +401,7 @@ class RBCP:
                 raise RBCPError("Bus Error")
             else:
                 raise RBCPError("Invalid CMD Flag")
-        if header.id != self.id:
+        if header.id != id_:
             raise RBCPError("Invalid ID")
         if header.data_length != data_length:
             raise RBCPError("Invalid DataLength")
@@ -141,3 +409,162 @@ class RBCP:
             raise RBCPError("Invalid Address")
         if header.data_length != len(received_data) - 8:
             raise RBCPError("Frame Error")
+
+
+class AsyncRBCPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, rbcp):
+        self.rbcp = rbcp
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        future = self.rbcp.pending.get(data[2])
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        logger.debug(f"AsyncRBCP: {exc}")
+
+
+class AsyncRBCP:
+    """asyncio counterpart of RBCP; the endpoint is reopened in each new event loop."""
+    def __init__(self, host, port, window=4, timeout=1.0, max_retries=3, link=None, tracer=None):
+        self.host = host
+        self.port = port
+        self.id = 0
+        self.window = window
+        self.max_retries = max_retries
+        self.link = link or RBCPLink(timeout)
+        self.tracer = tracer
+        self.transport = None
+        self.loop = None  # event loop of the transport
+        self.pending = {}  # id -> future of the reply
+
+    @property
+    def retry_count(self):
+        return self.link.retry_count
+
+    @property
+    def timeout_count(self):
+        return self.link.timeout_count
+
+    def statistics(self):
+        return self.link.statistics()
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.close()
+        if self.transport is None:
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: AsyncRBCPProtocol(self), remote_addr=(self.host, self.port))
+            self.semaphore = asyncio.Semaphore(self.window)
+            self.loop = loop
+        return self.transport
+
+    def close(self):
+        if self.transport is not None:
+            try:
+                self.transport.close()
+            except RuntimeError:
+                pass  # its event loop is closed already
+            self.transport = None
+            self.loop = None
+            self.pending.clear()
+
+    async def read(self, address, data_length):
+        read_data = bytearray()
+        for received_data in await self.transact(RBCP.read_packets(address, data_length)):
+            read_data.extend(received_data)
+        return read_data
+
+    async def read8bit(self, address, data_length):
+        return list(await self.read(address, data_length))
+
+    async def read16bit(self, address, data_length):
+        return list(struct.unpack('!{}H'.format(data_length), await self.read(address, data_length * 2)))
+
+    async def read32bit(self, address, data_length):
+        return list(struct.unpack('!{}I'.format(data_length), await self.read(address, data_length * 4)))
+
+    async def write(self, address, data):
+        await self.transact(RBCP.write_packets(address, data))
+
+    async def write8bit(self, address, data):
+        await self.write(address, data)
+
+    async def write16bit(self, address, data):
+        if isinstance(data, int):
+            data = [data]
+        await self.write(address, struct.pack('!{}H'.format(len(data)), *data))
+
+    async def write32bit(self, address, data):
+        if isinstance(data, int):
+            data = [data]
+        await self.write(address, struct.pack('!{}I'.format(len(data)), *data))
+
+    def batch(self):
+        return RBCPBatch(self)
+
+    async def transact(self, packets):
+        await self.open()
+        if self.link.is_open():
+            if not self.link.probe_due():
+                if self.tracer is not None and packets:
+                    self.tracer.record(self.host, *packets[0][:3], 0, 0.0, RBCPTracer.REJECTED)
+                raise RBCPError(f"Circuit open: {self.host} is not answering")
+            try:
+                await self.exchange(RBCPHeader.READ, RBCP.PROBE_ADDRESS, 1, b'\x00', 1)
+            except RBCPError:
+                raise RBCPError(f"Circuit open: {self.host} did not answer the probe")
+        try:
+            replies = await asyncio.gather(*(self.exchange(*packet, self.max_retries) for packet in packets))
+        except RBCPError:
+            self.link.failure()
+            raise
+        self.link.success()
+        return replies
+
+    async def com(self, rw, address, data_length, data):
+        return (await self.transact([(rw, address, data_length, data)]))[0]
+
+    async def exchange(self, rw, address, data_length, data, max_attempts):
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            id_ = self.next_id()
+            data_to_be_sent = RBCPHeader(rw, id_, data_length, address).to_bytes() + data
+            try:
+                for attempt in range(max_attempts):
+                    if attempt > 0:
+                        self.link.retry(isinstance(error, asyncio.TimeoutError))
+                    future = loop.create_future()
+                    self.pending[id_] = future
+                    sent_time = loop.time()
+                    self.transport.sendto(data_to_be_sent)
+                    try:
+                        received_data = await asyncio.wait_for(future, self.link.timeout(attempt))
+                        RBCP.validate(id_, rw, address, data_length, data, received_data)
+                    except (asyncio.TimeoutError, RBCPError) as e:
+                        error = e
+                        logger.debug(f"RBCP {self.host}: {e or 'Timeout'}")
+                        if self.tracer is not None:
+                            outcome = RBCPTracer.TIMEOUT if isinstance(e, asyncio.TimeoutError) else RBCPTracer.ERROR
+                            self.tracer.record(self.host, rw, address, data_length, id_, loop.time() - sent_time, outcome)
+                        continue
+                    latency = loop.time() - sent_time
+                    if attempt == 0:
+                        self.link.sample(latency)
+                    if self.tracer is not None:
+                        self.tracer.record(self.host, rw, address, data_length, id_, latency, RBCPTracer.OK)
+                    return received_data[8:]
+            finally:
+                self.pending.pop(id_, None)
+        raise RBCPError("Communication failed after retries")
+
+    def next_id(self):
+        while self.id in self.pending:
+            self.id = (self.id + 1) & 0xFF
+        id_ = self.id
+        self.id = (self.id + 1) & 0xFF
+        self.pending[id_] = None
+        return id_
@@ -0,0 +1,187 @@
+import logging
+import socket
+import selectors
+import threading
+import time
+from collections import deque
+
+from RBCP import RBCP, RBCPError
+from RBCPTracer import RBCPTracer
+
+logger = logging.getLogger(__name__)
+
+class RBCPHandle(RBCP):
+    """RBCP interface of one board, served by the socket of an RBCPMultiplexer."""
+    def __init__(self, mux, host, port, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.mux = mux
+        self.peer = (socket.gethostbyname(host), port)
+
+    def open(self):
+        return self.mux.sock
+
+    def close(self):
+        pass  # the socket belongs to the multiplexer
+
+    def exchange(self, packets, max_attempts):
+        replies = self.mux.exchange([(self, packets)], max_attempts)[0]
+        if isinstance(replies, RBCPError):
+            raise replies
+        return replies
+
+
+class RBCPMultiplexer:
+    """Serve any number of boards from one UDP socket and one selector loop.
+
+    handle(host) returns an RBCPHandle with the usual RBCP read/write
+    interface; VmeEasiroc accepts it through its `rbcp` argument. Replies
+    are routed by (host, ID). read_many()/write_many()/transact_many() run
+    the transactions of several boards in the same loop, each board keeping
+    its own window, RTT estimate and circuit breaker.
+    """
+    def __init__(self, window=4, timeout=1.0, max_retries=3):
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.handles = {}  # peer -> RBCPHandle
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', 0))
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+
+    def handle(self, host, port=4660):
+        peer = (socket.gethostbyname(host), port)
+        if peer not in self.handles:
+            self.handles[peer] = RBCPHandle(self, host, port, window=self.window,
+                                            timeout=self.timeout, max_retries=self.max_retries)
+        return self.handles[peer]
+
+    def close(self):
+        self.selector.close()
+        self.sock.close()
+
+    def read_many(self, requests):
+        """Read (handle, address, data_length) requests of several boards; return the data in order."""
+        jobs = [(handle, RBCP.read_packets(address, data_length)) for handle, address, data_length in requests]
+        return [r if isinstance(r, RBCPError) else bytearray(b''.join(r)) for r in self.transact_many(jobs)]
+
+    def write_many(self, requests):
+        """Write (handle, address, data) requests of several boards; return errors (None on success)."""
+        jobs = [(handle, RBCP.write_packets(address, data)) for handle, address, data in requests]
+        return [r if isinstance(r, RBCPError) else None for r in self.transact_many(jobs)]
+
+    def transact_many(self, jobs):
+        """Run (handle, packets) jobs concurrently.
+
+        Return one list of reply payloads per job, or the RBCPError of a
+        job that failed; a failing board does not stop the others.
+        """
+        results = [None] * len(jobs)
+        ready = []
+        probing = []
+        for i, (handle, packets) in enumerate(jobs):
+            if not handle.link.is_open():
+                ready.append(i)
+            elif handle.link.probe_due():
+                probing.append(i)
+            else:
+                if handle.tracer is not None and packets:
+                    handle.tracer.record(handle.host, *packets[0][:3], 0, 0.0, RBCPTracer.REJECTED)
+                results[i] = RBCPError(f"Circuit open: {handle.host} is not answering")
+
+        if probing:
+            probes = [(jobs[i][0], RBCP.read_packets(RBCP.PROBE_ADDRESS, 1)) for i in probing]
+            for i, reply in zip(probing, self.exchange(probes, 1)):
+                if isinstance(reply, RBCPError):
+                    results[i] = RBCPError(f"Circuit open: {jobs[i][0].host} did not answer the probe")
+                else:
+                    ready.append(i)
+
+        replies = self.exchange([jobs[i] for i in ready], [jobs[i][0].max_retries for i in ready])
+        for i, reply in zip(ready, replies):
+            if isinstance(reply, RBCPError):
+                jobs[i][0].link.failure()
+            else:
+                jobs[i][0].link.success()
+            results[i] = reply
+        return results
+
+    def exchange(self, jobs, max_attempts):
+        """Send the packets of every (handle, packets) job and collect the replies in one loop."""
+        if isinstance(max_attempts, int):
+            max_attempts = [max_attempts] * len(jobs)
+        with self.lock:
+            results = [[None] * len(packets) for _, packets in jobs]
+            queues = [deque(range(len(packets))) for _, packets in jobs]
+            remaining = [len(packets) for _, packets in jobs]
+            in_flight = {}  # (peer, id) -> [job, index, deadline, retries, sent_time]
+            busy = {handle.peer: set() for handle, _ in jobs}  # ids in flight per board
+
+            while any(remaining):
+                for j, (handle, packets) in enumerate(jobs):
+                    while queues[j] and len(busy[handle.peer]) < handle.window:
+                        index = queues[j].popleft()
+                        id_ = handle.next_id(busy[handle.peer])
+                        handle.com_sub(self.sock, id_, *packets[index])
+                        now = time.monotonic()
+                        in_flight[(handle.peer, id_)] = [j, index, now + handle.link.timeout(), 0, now]
+                        busy[handle.peer].add(id_)
+
+                deadline = min(entry[2] for entry in in_flight.values())
+                self.selector.select(max(deadline - time.monotonic(), 0))
+                while True:
+                    try:
+                        received_data, peer = self.sock.recvfrom(255 + 8)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    key = (peer, received_data[2]) if len(received_data) >= 8 else None
+                    if key not in in_flight:
+                        continue  # stale reply of a resent request or a stray packet
+                    j, index, _, retries, sent_time = in_flight[key]
+                    handle, packets = jobs[j]
+                    try:
+                        handle.validate(key[1], *packets[index], received_data)
+                    except RBCPError as e:
+                        self.retry(jobs, key, in_flight, busy, queues, remaining, results, max_attempts, e)
+                        continue
+                    latency = time.monotonic() - sent_time
+                    if retries == 0:
+                        handle.link.sample(latency)
+                    if handle.tracer is not None:
+                        handle.tracer.record(handle.host, *packets[index][:3], key[1], latency, RBCPTracer.OK)
+                    results[j][index] = received_data[8:]
+                    del in_flight[key]
+                    busy[peer].discard(key[1])
+                    remaining[j] -= 1
+
+                now = time.monotonic()
+                for key in [key for key, entry in in_flight.items() if entry[2] <= now]:
+                    if key in in_flight:  # a failing job may have dropped it already
+                        self.retry(jobs, key, in_flight, busy, queues, remaining, results,
+                                   max_attempts, RBCPError("Timeout"), True)
+            return results
+
+    def retry(self, jobs, key, in_flight, busy, queues, remaining, results, max_attempts, error, timed_out=False):
+        entry = in_flight[key]
+        j, index = entry[0], entry[1]
+        handle, packets = jobs[j]
+        logger.debug(f"RBCP {handle.host}: {error}")
+        if handle.tracer is not None:
+            outcome = RBCPTracer.TIMEOUT if timed_out else RBCPTracer.ERROR
+            handle.tracer.record(handle.host, *packets[index][:3], key[1], time.monotonic() - entry[4], outcome)
+        entry[3] += 1
+        if entry[3] >= max_attempts[j]:
+            # Give up on this job only; the other boards carry on
+            for other in [k for k, e in in_flight.items() if e[0] == j]:
+                del in_flight[other]
+                busy[other[0]].discard(other[1])
+            queues[j].clear()
+            remaining[j] = 0
+            results[j] = RBCPError("Communication failed after retries")
+            return
+        handle.link.retry(timed_out)
+        handle.com_sub(self.sock, key[1], *packets[index])
+        entry[2] = time.monotonic() + handle.link.timeout(entry[3])
+        entry[4] = time.monotonic()
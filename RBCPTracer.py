@@ -0,0 +1,109 @@
+import sys
+import time
+import socket
+import struct
+import optparse
+
+class RBCPTracer:
+    """Fixed-size binary ring buffer of RBCP transactions.
+
+    Each attempt is stored as one 24-byte record (timestamp, host, address,
+    latency, rw flag, length, ID, outcome) packed into a preallocated
+    bytearray, so recording costs one struct.pack_into and nothing is
+    printed. Use dump() to save the buffer and `python RBCPTracer.py <file>`
+    to decode it offline.
+    """
+    MAGIC = b'RBCPTRC1'
+    RECORD = struct.Struct('<dIIfBBBB')  # timestamp, host, address, latency, rw, length, id, outcome
+    FILE_HEADER = struct.Struct('<8sIQ')  # magic, record size, number of records
+
+    OK = 0
+    TIMEOUT = 1
+    ERROR = 2
+    REJECTED = 3
+    OUTCOMES = {OK: 'ok', TIMEOUT: 'timeout', ERROR: 'error', REJECTED: 'rejected'}
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.buffer = bytearray(self.RECORD.size * capacity)
+        self.count = 0  # records written since creation, the ring keeps the last `capacity`
+        self.hosts = {}
+
+    def record(self, host, rw, address, data_length, id_, latency, outcome):
+        host_id = self.hosts.get(host)
+        if host_id is None:
+            host_id = self.hosts[host] = struct.unpack('!I', socket.inet_aton(socket.gethostbyname(host)))[0]
+        self.RECORD.pack_into(self.buffer, (self.count % self.capacity) * self.RECORD.size,
+                              time.time(), host_id, address, latency, rw, data_length, id_, outcome)
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def raw_records(self):
+        """Return the stored records as bytes, oldest first."""
+        if self.count <= self.capacity:
+            return bytes(self.buffer[:self.count * self.RECORD.size])
+        split = (self.count % self.capacity) * self.RECORD.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def records(self):
+        return self.decode(self.raw_records())
+
+    def dump(self, filename):
+        data = self.raw_records()
+        with open(filename, 'wb') as file:
+            file.write(self.FILE_HEADER.pack(self.MAGIC, self.RECORD.size, len(data) // self.RECORD.size))
+            file.write(data)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as file:
+            magic, record_size, count = cls.FILE_HEADER.unpack(file.read(cls.FILE_HEADER.size))
+            if magic != cls.MAGIC or record_size != cls.RECORD.size:
+                raise ValueError(f"{filename} is not an RBCP trace")
+            return list(cls.decode(file.read(count * record_size)))
+
+    @classmethod
+    def decode(cls, data):
+        for timestamp, host, address, latency, rw, data_length, id_, outcome in cls.RECORD.iter_unpack(data):
+            yield {
+                'timestamp': timestamp,
+                'host': socket.inet_ntoa(struct.pack('!I', host)),
+                'rw': 'R' if rw == 0xC0 else 'W',
+                'address': address,
+                'length': data_length,
+                'id': id_,
+                'latency': latency,
+                'outcome': cls.OUTCOMES.get(outcome, str(outcome)),
+            }
+
+    @staticmethod
+    def format(record):
+        stamp = time.strftime('%H:%M:%S', time.localtime(record['timestamp']))
+        return (f"{stamp}.{int(record['timestamp'] * 1e6) % 1000000:06d} {record['host']:>15} "
+                f"{record['rw']} 0x{record['address']:08X} len={record['length']:3d} id={record['id']:3d} "
+                f"{record['latency'] * 1e3:9.3f} ms {record['outcome']}")
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [options] <trace file>')
+    parser.add_option('-n', '--last', dest='last', type='int', default=0, help='show only the last N records')
+    parser.add_option('-f', '--failures', dest='failures', action='store_true', help='show only failed attempts')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    records = RBCPTracer.load(args[0])
+    if options.failures:
+        records = [r for r in records if r['outcome'] != 'ok']
+    if options.last:
+        records = records[-options.last:]
+    for record in records:
+        print(RBCPTracer.format(record))
+
+    latencies = sorted(r['latency'] for r in records if r['outcome'] == 'ok')
+    if latencies:
+        print(f"{len(records)} records, {len(latencies)} ok, "
+              f"latency median {latencies[len(latencies) // 2] * 1e3:.3f} ms, max {latencies[-1] * 1e3:.3f} ms")
@@ -1,11 +1,14 @@
 from ConfigLoader import ConfigLoader
-from RBCP import RBCP
+from RBCP import RBCP, AsyncRBCP
+from EventParser import EventParser
+import asyncio
 import logging
 import os
 import time
 import socket
 import struct
 import select
+import numpy as np
 #from struct import pack
 
 logger = logging.getLogger(__name__)
@@ -26,11 +29,15 @@ class Easiroc:
         self.rstb_read = True
 
 class VmeEasiroc:
-    def __init__(self, host, tcp_port, udp_port, yaml_dir):
+    def __init__(self, host, tcp_port, udp_port, yaml_dir, rbcp=None):
         self.host = host
         self.tcp_port = tcp_port
-        self.rbcp = RBCP(self.host, udp_port)
+        # rbcp: e.g. a handle of an RBCPMultiplexer shared by many modules
+        self.rbcp = rbcp or RBCP(self.host, udp_port)
+        self.async_rbcp = AsyncRBCP(self.host, udp_port)
         self.yaml_dir = yaml_dir
+        # Shadow copy of the last image successfully written to each register region
+        self.shadow = {}
 
         self.send_adc = False
         self.send_tdc = False
@@ -61,7 +68,7 @@ class VmeEasiroc:
     def easiroc2(self, value):
         self._easiroc2 = value
 
-    def send_direct_control(self):
+    def direct_control_register(self):
         # KK address = self.direct_control_address()
         direct_control_register0 = [
             # MSB
@@ -120,15 +127,193 @@ class VmeEasiroc:
             direct_control_register[1],
             direct_control_register[2]
         ))
+        return direct_control_register
 
-        self.rbcp.write(self.direct_control_address(), direct_control_register)
+    def send_direct_control(self):
+        self.rbcp.write(self.direct_control_address(), self.direct_control_register())
 
-    def send_slow_control(self):
-        self.easiroc1.select_sc = True
-        self.easiroc2.select_sc = True
-        self.send_slow_control_sub(self.easiroc1.slow_control, self.easiroc2.slow_control)
+    async def async_send_direct_control(self):
+        await self.async_rbcp.write(self.direct_control_address(), self.direct_control_register())
+
+    def is_dirty(self, region, image, force=False):
+        if force or self.shadow.get(region) != image:
+            return True
+        logger.debug(f"{region}: unchanged since last write, not sent")
+        return False
 
-    def send_probe_register(self):
+    def mark_clean(self, region, image):
+        self.shadow[region] = image
+
+    def write_region(self, region, address, image, force=False):
+        if self.is_dirty(region, image, force):
+            self.rbcp.write(address, image)
+            self.mark_clean(region, image)
+
+    async def async_write_region(self, region, address, image, force=False):
+        if self.is_dirty(region, image, force):
+            await self.async_rbcp.write(address, image)
+            self.mark_clean(region, image)
+
+    def invalidate_shadow(self, region=None):
+        if region is None:
+            self.shadow.clear()
+        else:
+            self.shadow.pop(region, None)
+
+    def send_configuration(self, force=False):
+        """Push the configuration register groups that changed."""
+        if not self.send_slow_control(force):
+            self.send_probe_register(force)  # otherwise already loaded again after the slow control
+        self.send_read_register(force)
+        self.send_pedestal_suppression(force)
+        self.send_selectable_logic(force)
+        self.send_trigger_pla(force)
+        self.send_trigger_width(force)
+        self.send_time_window(force)
+        self.send_usr_clk_out_register(force)
+        self.send_trigger_values(force)
+
+    async def async_send_configuration(self, force=False):
+        if not await self.async_send_slow_control(force):
+            await self.async_send_probe_register(force)
+        await self.async_send_read_register(force)
+        await self.async_send_pedestal_suppression(force)
+        await self.async_send_selectable_logic(force)
+        await self.async_send_trigger_pla(force)
+        await self.async_send_trigger_width(force)
+        await self.async_send_time_window(force)
+        await self.async_send_usr_clk_out_register(force)
+        await self.async_send_trigger_values(force)
+
+    def configuration_image(self):
+        """Return the (region, address, bytes) writes of send_configuration."""
+        # The slow control and probe registers are loaded through one buffer, which keeps the
+        # image written last: the probe register, as send_configuration sends it after the
+        # slow control, unless something else was written since.
+        buffer1, buffer2 = self.shadow.get('sc_buffer', (bytes(self.easiroc1.probe), bytes(self.easiroc2.probe)))
+        writes = [
+            ('sc_buffer', self.slow_control1_address(), buffer1),
+            ('sc_buffer', self.slow_control2_address(), buffer2),
+        ]
+        if self.easiroc1.read_register >= 0:
+            writes.append(('read_register', self.read_register1_address(), bytes([self.easiroc1.read_register])))
+        if self.easiroc2.read_register >= 0:
+            writes.append(('read_register', self.read_register2_address(), bytes([self.easiroc2.read_register])))
+        writes += [
+            ('pedestal_suppression', self.pedestal_suppression_address(), self.pedestal_suppression_image()),
+            ('selectable_logic', self.selectable_logic_address(), self.selectable_logic_image()),
+        ]
+        writes += [('trigger_pla', address, bytes(data)) for address, data in self.trigger_pla_batch(self.rbcp).regions()]
+        writes += [
+            ('trigger_width', self.trigger_width_address(), self.trigger_width_image()),
+            ('time_window', self.time_window_address(), self.time_window_image()),
+            ('usr_clk_out', self.usr_clk_out_address(), bytes([self.usr_clk_out])),
+            ('trigger_values', self.trigger_values_address(), self.trigger_values_image()),
+        ]
+        return writes
+
+    def run_metadata(self):
+        return {
+            'host': self.host,
+            'start_time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'new_format': self.new_format,
+            'send_adc': self.send_adc,
+            'send_tdc': self.send_tdc,
+            'send_scaler': self.send_scaler,
+            'send_stp': self.send_stp,
+            'time_window': self.config_loader.to_time_window(),
+            'read_register': [self.easiroc1.read_register, self.easiroc2.read_register],
+        }
+
+    def verify_configuration(self):
+        """Read the configuration back; return the (region, address, expected, read) mismatches."""
+        writes = self.configuration_image()
+        batch = self.rbcp.batch()
+        for _, address, data in writes:
+            batch.write(address, data)
+        expected = batch.regions()
+
+        packet_count = lambda start, end: -(-(end - start) // 255)
+        spans = []
+        for address, data in expected:
+            end = address + len(data)
+            if spans and packet_count(spans[-1][0], end) <= packet_count(*spans[-1]) + packet_count(address, end):
+                spans[-1][1] = end
+            else:
+                spans.append([address, end])
+
+        packets = []
+        for start, end in spans:
+            packets.extend(RBCP.read_packets(start, end - start))
+        replies = self.rbcp.transact(packets)
+        read_back = {}
+        for (_, address, data_length, _), reply in zip(packets, replies):
+            read_back.update(zip(range(address, address + data_length), reply))
+
+        owner = {}  # address -> region that wrote it last
+        for region, address, data in writes:
+            for offset in range(len(data)):
+                owner[address + offset] = region
+        mismatches = []
+        for address, data in expected:
+            for offset, value in enumerate(data):
+                if read_back[address + offset] != value:
+                    mismatches.append((owner[address + offset], address + offset, value, read_back[address + offset]))
+
+        for region in dict.fromkeys(m[0] for m in mismatches):
+            wrong = [m for m in mismatches if m[0] == region]
+            logger.warning(f"{region}: {len(wrong)} byte(s) differ from the configuration, "
+                           f"first at 0x{wrong[0][1]:08X} (expected 0x{wrong[0][2]:02X}, read 0x{wrong[0][3]:02X})")
+            self.invalidate_shadow(region)
+            if region == 'sc_buffer':
+                # what the chips loaded from the buffer is in doubt as well
+                self.invalidate_shadow('slow_control')
+                self.invalidate_shadow('probe')
+        logger.debug(f"Configuration verified with {len(packets)} read packet(s), {len(mismatches)} mismatch(es)")
+        return mismatches
+
+    def send_slow_control(self, force=False):
+        """Return True if the slow control register was sent."""
+        image = bytes(self.easiroc1.slow_control) + bytes(self.easiroc2.slow_control)
+        if self.is_dirty('slow_control', image, force):
+            self.easiroc1.select_sc = True
+            self.easiroc2.select_sc = True
+            self.send_slow_control_sub(self.easiroc1.slow_control, self.easiroc2.slow_control)
+            self.mark_clean('slow_control', image)
+            # the probe register goes through the same buffer and select_sc: load it again
+            # so that the module is left with the probe register selected, as always before
+            self.send_probe_register(force=True)
+            return True
+        return False
+
+    async def async_send_slow_control(self, force=False):
+        image = bytes(self.easiroc1.slow_control) + bytes(self.easiroc2.slow_control)
+        if self.is_dirty('slow_control', image, force):
+            self.easiroc1.select_sc = True
+            self.easiroc2.select_sc = True
+            await self.async_send_slow_control_sub(self.easiroc1.slow_control, self.easiroc2.slow_control)
+            self.mark_clean('slow_control', image)
+            await self.async_send_probe_register(force=True)
+            return True
+        return False
+
+    def send_probe_register(self, force=False):
+        self.select_probe_register()
+        image = bytes(self.easiroc1.probe) + bytes(self.easiroc2.probe)
+        if self.is_dirty('probe', image, force):
+            logger.debug('Send ProbeRegister')
+            self.send_slow_control_sub(self.easiroc1.probe, self.easiroc2.probe)
+            self.mark_clean('probe', image)
+
+    async def async_send_probe_register(self, force=False):
+        self.select_probe_register()
+        image = bytes(self.easiroc1.probe) + bytes(self.easiroc2.probe)
+        if self.is_dirty('probe', image, force):
+            logger.debug('Send ProbeRegister')
+            await self.async_send_slow_control_sub(self.easiroc1.probe, self.easiroc2.probe)
+            self.mark_clean('probe', image)
+
+    def select_probe_register(self):
         self.easiroc1.select_sc = False
         self.easiroc2.select_sc = False
 
@@ -142,26 +327,19 @@ class VmeEasiroc:
         else:
             logger.debug('SelectProbe: EASIROC2 >> ON')
 
-        logger.debug('Send ProbeRegister')
-        self.send_slow_control_sub(self.easiroc1.probe, self.easiroc2.probe)
-
     def reset_probe_register(self):
         self.easiroc1.select_sc = False
         self.easiroc2.select_sc = False
 
         logger.debug('Reset Probe Register')
+        self.invalidate_shadow('probe')
         self.send_slow_control_sub([0] * 20, [0] * 20)
+        self.mark_clean('probe', bytes(40))
 
-    def send_read_register(self):
-        if self.easiroc1.read_register == -1:
-            logger.debug('SelectHg : EASIROC1 >> OFF')
-        else:
-            logger.debug('SelectHg : EASIROC1 >> ON')
-
-        if self.easiroc2.read_register == -1:
-            logger.debug('SelectHg : EASIROC2 >> OFF')
-        else:
-            logger.debug('SelectHg : EASIROC2 >> ON')
+    def send_read_register(self, force=False):
+        image = self.read_register_image()
+        if not self.is_dirty('read_register', image, force):
+            return
 
         self.reset_read_register()
 
@@ -174,14 +352,53 @@ class VmeEasiroc:
             logger.debug(f"ReadRegister: {self.easiroc2.read_register}")
             address = self.read_register2_address()
             self.rbcp.write(address, self.easiroc2.read_register)
+        self.mark_clean('read_register', image)
 
-    def send_pedestal_suppression(self):
-        address = self.pedestal_suppression_address()
+    async def async_send_read_register(self, force=False):
+        image = self.read_register_image()
+        if not self.is_dirty('read_register', image, force):
+            return
+
+        await self.async_reset_read_register()
+
+        if self.easiroc1.read_register >= 0:
+            logger.debug(f"ReadRegister: {self.easiroc1.read_register}")
+            address = self.read_register1_address()
+            await self.async_rbcp.write(address, self.easiroc1.read_register)
+
+        if self.easiroc2.read_register >= 0:
+            logger.debug(f"ReadRegister: {self.easiroc2.read_register}")
+            address = self.read_register2_address()
+            await self.async_rbcp.write(address, self.easiroc2.read_register)
+        self.mark_clean('read_register', image)
+
+    def read_register_image(self):
+        if self.easiroc1.read_register == -1:
+            logger.debug('SelectHg : EASIROC1 >> OFF')
+        else:
+            logger.debug('SelectHg : EASIROC1 >> ON')
+
+        if self.easiroc2.read_register == -1:
+            logger.debug('SelectHg : EASIROC2 >> OFF')
+        else:
+            logger.debug('SelectHg : EASIROC2 >> ON')
+        return (self.easiroc1.read_register, self.easiroc2.read_register)
+
+    def pedestal_suppression_image(self):
         pedestal_suppression_value = self.config_loader.to_pedestal_suppression()['HG'] + self.config_loader.to_pedestal_suppression()['LG']
         logger.debug(f"PedestalSuppression: {pedestal_suppression_value}")
-        self.rbcp.write16bit(address, pedestal_suppression_value)
+        return struct.pack('!{}H'.format(len(pedestal_suppression_value)), *pedestal_suppression_value)
+
+    def send_pedestal_suppression(self, force=False):
+        address = self.pedestal_suppression_address()
+        self.write_region('pedestal_suppression', address, self.pedestal_suppression_image(), force)
+
+    async def async_send_pedestal_suppression(self, force=False):
+        address = self.pedestal_suppression_address()
+        await self.async_write_region('pedestal_suppression', address, self.pedestal_suppression_image(), force)
 
     def reset_read_register(self):
+        self.invalidate_shadow('read_register')
         self.easiroc1.rstb_read = False
         self.easiroc2.rstb_read = False
         self.send_direct_control()
@@ -189,66 +406,118 @@ class VmeEasiroc:
         self.easiroc1.rstb_read = True
         self.easiroc2.rstb_read = True
         self.send_direct_control()
-        
-    def send_selectable_logic(self):
-        address = self.selectable_logic_address()
 
+    async def async_reset_read_register(self):
+        self.invalidate_shadow('read_register')
+        self.easiroc1.rstb_read = False
+        self.easiroc2.rstb_read = False
+        await self.async_send_direct_control()
+
+        self.easiroc1.rstb_read = True
+        self.easiroc2.rstb_read = True
+        await self.async_send_direct_control()
+
+    def selectable_logic_image(self):
         selectable_logic = self.config_loader.to_selectable_logic()
         logger.debug(f"SelectableLogic: {selectable_logic}")
-        self.rbcp.write(address, selectable_logic)
+        return bytes(selectable_logic)
+
+    def send_selectable_logic(self, force=False):
+        address = self.selectable_logic_address()
+        self.write_region('selectable_logic', address, self.selectable_logic_image(), force)
+
+    async def async_send_selectable_logic(self, force=False):
+        address = self.selectable_logic_address()
+        await self.async_write_region('selectable_logic', address, self.selectable_logic_image(), force)
 
-    def send_trigger_pla(self):
+    def trigger_pla_batch(self, rbcp):
         address = self.trigger_pla_address()
 
         trigger_pla_value = self.config_loader.to_trigger_pla()
         logger.debug(f"TriggerPla: {trigger_pla_value}")
-        self.rbcp.write(address, trigger_pla_value['Cmd'])
-        self.rbcp.write(address + 1, trigger_pla_value['Channel'])
-        self.rbcp.write(address + 2, trigger_pla_value['C_moni1'])
-        self.rbcp.write(address + 3, trigger_pla_value['C_moni2'])
-        self.rbcp.write32bit(address + 4, trigger_pla_value['AndLogicCh1x'])
-        self.rbcp.write32bit(address + 68, trigger_pla_value['AndLogicCh2x'])
-        self.rbcp.write32bit(address + 132, trigger_pla_value['OrLogicCh1x'][0])
-        self.rbcp.write32bit(address + 140, trigger_pla_value['OrLogicCh1x'][1])
-        self.rbcp.write32bit(address + 148, trigger_pla_value['OrLogicCh1x'][2])
-        self.rbcp.write32bit(address + 156, trigger_pla_value['OrLogicCh1x'][3])
-        self.rbcp.write32bit(address + 136, trigger_pla_value['OrLogicCh2x'][0])
-        self.rbcp.write32bit(address + 144, trigger_pla_value['OrLogicCh2x'][1])
-        self.rbcp.write32bit(address + 152, trigger_pla_value['OrLogicCh2x'][2])
-        self.rbcp.write32bit(address + 160, trigger_pla_value['OrLogicCh2x'][3])
-
-    def send_trigger_width(self):
-        address = self.trigger_width_address()
-
+        batch = rbcp.batch()
+        batch.write(address, trigger_pla_value['Cmd'])
+        batch.write(address + 1, trigger_pla_value['Channel'])
+        batch.write(address + 2, trigger_pla_value['C_moni1'])
+        batch.write(address + 3, trigger_pla_value['C_moni2'])
+        batch.write32bit(address + 4, trigger_pla_value['AndLogicCh1x'])
+        batch.write32bit(address + 68, trigger_pla_value['AndLogicCh2x'])
+        batch.write32bit(address + 132, trigger_pla_value['OrLogicCh1x'][0])
+        batch.write32bit(address + 140, trigger_pla_value['OrLogicCh1x'][1])
+        batch.write32bit(address + 148, trigger_pla_value['OrLogicCh1x'][2])
+        batch.write32bit(address + 156, trigger_pla_value['OrLogicCh1x'][3])
+        batch.write32bit(address + 136, trigger_pla_value['OrLogicCh2x'][0])
+        batch.write32bit(address + 144, trigger_pla_value['OrLogicCh2x'][1])
+        batch.write32bit(address + 152, trigger_pla_value['OrLogicCh2x'][2])
+        batch.write32bit(address + 160, trigger_pla_value['OrLogicCh2x'][3])
+        return batch
+
+    def send_trigger_pla(self, force=False):
+        batch = self.trigger_pla_batch(self.rbcp)
+        image = batch.regions()
+        if self.is_dirty('trigger_pla', image, force):
+            batch.flush()
+            self.mark_clean('trigger_pla', image)
+
+    async def async_send_trigger_pla(self, force=False):
+        batch = self.trigger_pla_batch(self.async_rbcp)
+        image = batch.regions()
+        if self.is_dirty('trigger_pla', image, force):
+            await batch.flush()
+            self.mark_clean('trigger_pla', image)
+
+    def trigger_width_image(self):
         trigger_width = self.config_loader.to_trigger_width()
         logger.debug(f"TriggerWidth: {trigger_width}")
-        self.rbcp.write(address, trigger_width)
+        return bytes([trigger_width])
 
-    def send_time_window(self):
-        address = self.time_window_address()
+    def send_trigger_width(self, force=False):
+        address = self.trigger_width_address()
+        self.write_region('trigger_width', address, self.trigger_width_image(), force)
+
+    async def async_send_trigger_width(self, force=False):
+        address = self.trigger_width_address()
+        await self.async_write_region('trigger_width', address, self.trigger_width_image(), force)
+
+    def time_window_image(self):
         time_window = self.config_loader.to_time_window()
         logger.info(f"TimeWIndow: {time_window}")
-        self.rbcp.write16bit(address, time_window)
-        
-    def send_trigger_values(self):
-        address = self.trigger_values_address()
+        return struct.pack('!H', time_window)
 
+    def send_time_window(self, force=False):
+        address = self.time_window_address()
+        self.write_region('time_window', address, self.time_window_image(), force)
+
+    async def async_send_time_window(self, force=False):
+        address = self.time_window_address()
+        await self.async_write_region('time_window', address, self.time_window_image(), force)
+
+    def trigger_values_image(self):
+        # Mode at +0 and the three delays at +1..+3 form one contiguous packet
         trigger_mode = self.config_loader.to_trigger_mode()
         logger.debug(f"TriggerMode: {trigger_mode}")
-        self.rbcp.write(address, trigger_mode)
-
         trigger_delay = self.config_loader.to_trigger_delay()
         logger.debug(f"TriggerDelay: {trigger_delay}")
-        self.rbcp.write(address + 1, trigger_delay)
+        return bytes([trigger_mode] + trigger_delay)
+
+    def send_trigger_values(self, force=False):
+        address = self.trigger_values_address()
+        self.write_region('trigger_values', address, self.trigger_values_image(), force)
+
+    async def async_send_trigger_values(self, force=False):
+        address = self.trigger_values_address()
+        await self.async_write_region('trigger_values', address, self.trigger_values_image(), force)
 
     def send_trigger_mode(self, ivalue):
         address = self.trigger_values_address()
         logger.debug(f"TriggerMode: {ivalue}")
+        self.invalidate_shadow('trigger_values')
         self.rbcp.write(address, ivalue)
 
     def send_trigger_delay(self, ivalue):
         address = self.trigger_values_address() + 1
         logger.debug(f"TriggerDelay: {ivalue}")
+        self.invalidate_shadow('trigger_values')
         self.rbcp.write(address, ivalue)
 
     def easiroc1_slow_control(self):
@@ -338,7 +607,7 @@ class VmeEasiroc:
         return self.config_loader.summary()
 
     def version(self):
-        address = self.version_address
+        address = self.version_address()
         combined_data = self.rbcp.read(address, 6)
 
         version = combined_data[0:2]
@@ -361,23 +630,31 @@ class VmeEasiroc:
 
     def read_event(self, number_to_read):
         print(f'  DEBUG: read_event {number_to_read} {self.host}')
+        yield from self.daq_stream(self.receive_events(number_to_read))
+
+    def read_event_batches(self, number_to_read, batch_size=1024):
+        """Yield (words, offsets, headers) per `batch_size` events; event i is words[offsets[i]:offsets[i + 1]]."""
+        print(f'  DEBUG: read_event_batches {number_to_read} {self.host}')
+        yield from self.daq_stream(self.receive_event_batches(number_to_read, batch_size))
+
+    def read_raw(self, number_to_read, chunk_size=1 << 20):
+        """Yield (chunk, events) of the raw stream; chunk is reused, write it out before the next one."""
+        if number_to_read is not None and number_to_read <= 0:
+            return
+        print(f'  DEBUG: read_raw {number_to_read} {self.host}')
+        yield from self.daq_stream(self.receive_raw(number_to_read, chunk_size))
+
+    def daq_stream(self, receiver):
         try:
             self.sock = socket.create_connection((self.host, self.tcp_port), timeout=None) # Timeout
             print(f'  DEBUG: Successfully connected to {self.host}:{self.tcp_port}')
             try:
-                #print(f'  DEBUG: read_event (2) {self.host}')
                 self.read_and_throw_previous_data()
-                #print(f'  DEBUG: read_event (3) {self.host}')
                 with self.enter_daq_mode():
-                    for _ in range(number_to_read):
-                        #print(f'  DEBUG: read_event (4) {self.host}')
-                        header = self.receive_header()
-                        #print(f"  DEBUG: data_size = {header['data_size']}")
-                        data = self.receive_data(header['data_size'])
-                        #print(f'  DEBUG: data = {header} {len(data)}')
-                        yield header, data
+                    yield from receiver
                 self.read_and_throw_previous_data()
             finally:
+                receiver.close()
                 self.sock.close()
         except (socket.timeout, ConnectionRefusedError) as e:
             print(f"  DEBUG: Connection failed: {e}")
@@ -386,6 +663,47 @@ class VmeEasiroc:
             print(f"  DEBUG: Socket error occurred: {e}")
             self.sock = None  # Disable socket as None
 
+    def receive_raw(self, number_to_read, chunk_size):
+        buffer = memoryview(bytearray(chunk_size))
+        header = bytearray()  # header bytes split over two chunks
+        position = 0  # stream offset of the start of the current chunk
+        cursor = 0  # stream offset of the next header byte
+        stop = None  # stream offset of the end of the last event
+        events = 0
+        self.sock.settimeout(None)
+        while stop is None or position < stop:
+            limit = chunk_size if stop is None else min(chunk_size, stop - position)
+            n = self.sock.recv_into(buffer[:limit])
+            if n == 0:
+                raise ConnectionError("Connection closed before receiving all data")
+            chunk = buffer[:n]
+            completed = 0
+            while stop is None and cursor < position + n:
+                offset = cursor - position
+                piece = chunk[offset:offset + 4 - len(header)]
+                header += piece
+                cursor += len(piece)
+                if len(header) < 4:
+                    break
+                cursor += 4 * self.check_header(self.WORD.unpack(header)[0])
+                header.clear()
+                completed += 1
+                events += 1
+                if events == number_to_read:
+                    stop = cursor
+            yield chunk if stop is None else chunk[:stop - position], completed
+            position += n
+
+    def check_header(self, word):
+        header = self.decode_word(word)
+        if self.new_format:
+            # the low bits of a word without the header mark would be taken as the next event size
+            if (header & 0xFFFF0000) != 0xFF7C0000:
+                raise ValueError("Frame Error 3")
+        elif (header >> 27) & 1 != 1:
+            raise ValueError("Frame Error 3")
+        return header & 0x0FFF
+
     def send_madc_control(self):
         address = self.monitor_adc_address()
         # Set ADC rate to 50Hz
@@ -480,9 +798,13 @@ class VmeEasiroc:
         self.rbcp.write(address + 2, mux)
         time.sleep(0.01)  # default 0.2
     
-    def send_usr_clk_out_register(self):
+    def send_usr_clk_out_register(self, force=False):
         address = self.usr_clk_out_address()
-        self.rbcp.write(address, self.usr_clk_out)
+        self.write_region('usr_clk_out', address, bytes([self.usr_clk_out]), force)
+
+    async def async_send_usr_clk_out_register(self, force=False):
+        address = self.usr_clk_out_address()
+        await self.async_write_region('usr_clk_out', address, bytes([self.usr_clk_out]), force)
 
     def send_stp_mode_register(self, ivalue):
         address = self.stp_mode_address()
@@ -615,9 +937,6 @@ class VmeEasiroc:
         self.start_cycle2 = False
         self.send_direct_control()
 
-        print("easiroc1 (int list):", list(easiroc1))
-        print("hex     :", [f"{b:02X}" for b in easiroc1])
-        
         logger.debug("VmeEasiroc::sendSlowControl:")
         logger.debug("Easiroc1")
         logger.debug("".join(f"{i:02X}, " for i in easiroc1))
@@ -629,6 +948,7 @@ class VmeEasiroc:
         logger.debug("".join(f"{i:02X}, " for i in easiroc2))
         address = self.slow_control2_address()
         self.rbcp.write(address, easiroc2)
+        self.mark_clean('sc_buffer', (bytes(easiroc1), bytes(easiroc2)))
 
         self.start_cycle1 = True
         self.start_cycle2 = True
@@ -646,6 +966,44 @@ class VmeEasiroc:
         self.easiroc2.load_sc = False
         self.send_direct_control()
 
+    async def async_send_slow_control_sub(self, easiroc1, easiroc2):
+        self.easiroc1.load_sc = False
+        self.easiroc1.rstb_sr = True
+        self.easiroc2.load_sc = False
+        self.easiroc2.rstb_sr = True
+        self.start_cycle1 = False
+        self.start_cycle2 = False
+        await self.async_send_direct_control()
+
+        logger.debug("VmeEasiroc::sendSlowControl:")
+        logger.debug("Easiroc1")
+        logger.debug("".join(f"{i:02X}, " for i in easiroc1))
+        address = self.slow_control1_address()
+        await self.async_rbcp.write(address, easiroc1)
+
+        logger.debug("VmeEasiroc::sendSlowControl:")
+        logger.debug("Easiroc2")
+        logger.debug("".join(f"{i:02X}, " for i in easiroc2))
+        address = self.slow_control2_address()
+        await self.async_rbcp.write(address, easiroc2)
+        self.mark_clean('sc_buffer', (bytes(easiroc1), bytes(easiroc2)))
+
+        self.start_cycle1 = True
+        self.start_cycle2 = True
+        await self.async_send_direct_control()
+
+        await asyncio.sleep(0.1)
+
+        self.easiroc1.load_sc = True
+        self.easiroc2.load_sc = True
+        self.start_cycle1 = False
+        self.start_cycle2 = False
+        await self.async_send_direct_control()
+
+        self.easiroc1.load_sc = False
+        self.easiroc2.load_sc = False
+        await self.async_send_direct_control()
+
     def write_status_register(self, data=0):
         address = self.status_register_address()
         if self.daq_mode:
@@ -704,65 +1062,66 @@ class VmeEasiroc:
                   ((word & 0x00007F00) >> 1) | ((word & 0x0000007F) >> 0)
             return ret
 
-    def receive_n_byte(self, num_bytes):
-        #print(f'  DEBUG: receive_n_byte (0) {self.host}')
-        data = b''
-        received_bytes = 0
-        self.sock.settimeout(None) # Never time out
-        while received_bytes < num_bytes:
-            #print(f'  DEBUG: receive_n_byte (1) {self.host} {num_bytes} - {received_bytes}')
+    WORD = struct.Struct('>I')
+
+    def receive_parsed(self, number_to_read, chunk_size=1 << 18, timeout=None):
+        """Yield (words, starts, ends) per received chunk; with a timeout, an empty result when idle."""
+        parser = EventParser(self.new_format)
+        buffer = bytearray(chunk_size + parser.MAX_EVENT_BYTES)
+        view = memoryview(buffer)
+        filled = 0
+        remaining = number_to_read
+        self.sock.settimeout(timeout) # None: never time out
+        while remaining is None or remaining > 0:
             try:
-                chunk = self.sock.recv(num_bytes - received_bytes)
-                if not chunk:
-                    raise ConnectionError("Connection closed before receiving all data")
-                #data += chunk
-                received_data = chunk
+                n = self.sock.recv_into(view[filled:])
             except socket.timeout:
-                print("Receiving data timed out")
-                raise
-            except socket.error as e:
-                print(f"Socket error: {e}")
-                raise
-
-            #print(f'  DEBUG: receive_n_byte (2) {self.host}')
-            if not received_data:
-                raise ConnectionError("Socket connection closed unexpectedly.")
-            #print(f'  DEBUG: receive_n_byte (3) {self.host}')
-            data += received_data
-            received_bytes += len(received_data)
-        return data
-
-    def receive_header(self):
-        #print(f'  DEBUG: receive_header (0) {self.host}')
-        raw_header = self.receive_n_byte(4)
-        header = self.decode_word(struct.unpack(">I", raw_header)[0])  # Big-endian unsigned int
-        #print(f'  DEBUG: receive_header (1) {self.host}')
-        if self.new_format:
-            #print(f'  DEBUG: receive_header (2.1) {self.host}')
-            if (header & 0xFFFF0000) == 0xFF7C0000:
-                is_header = 1
-            else:
-                is_header = 0
-        else:
-            #print(f'  DEBUG: receive_header (2.2) {self.host}')
-            is_header = (header >> 27) & 1
-            if is_header != 1:
-                raise ValueError("Frame Error 3")
-        
-        data_size = header & 0x0FFF
-        return {"data_size": data_size, "header": struct.pack(">I", header)}
-
-    def receive_data(self, data_size):
-        raw_data = self.receive_n_byte(4 * data_size)
-        words = struct.unpack(f">{data_size}I", raw_data)  # Big-endian unsigned ints
-        data = [self.decode_word(word) for word in words]
-        if self.new_format:
-            if not all((word >> 31) & 1 == 1 for word in data):
-                raise ValueError("Frame Error 4")
-        else:
-            if not all((word >> 27) & 1 == 0 for word in data):
-                raise ValueError("Frame Error 5")
-        return data
+                yield parser.parse(view[:0])[:3]
+                continue
+            if n == 0:
+                raise ConnectionError("Connection closed before receiving all data")
+            filled += n
+            words, starts, ends, consumed = parser.parse(view[:filled], remaining)
+            yield words, starts, ends
+            if remaining is not None:
+                remaining -= len(starts)
+            buffer[:filled - consumed] = buffer[consumed:filled]
+            filled -= consumed
+
+    def receive_events(self, number_to_read, chunk_size=1 << 18):
+        for words, starts, ends in self.receive_parsed(number_to_read, chunk_size):
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                header = {"data_size": end - start - 1, "header": self.WORD.pack(int(words[start]))}
+                yield header, words[start + 1:end]
+
+    def receive_event_batches(self, number_to_read, batch_size, chunk_size=1 << 18):
+        pending = []  # (data, sizes, headers) of the events not yet yielded
+        pending_events = 0
+        for words, starts, ends in self.receive_parsed(number_to_read, chunk_size):
+            if len(starts) == 0:
+                continue
+            # the parsed events are contiguous from word 0, drop their headers to get the data
+            pending.append((np.delete(words[:ends[-1]], starts), ends - starts - 1, words[starts]))
+            pending_events += len(starts)
+            if pending_events < batch_size:
+                continue
+
+            data, sizes, headers = (np.concatenate(arrays) for arrays in zip(*pending))
+            offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+            np.cumsum(sizes, out=offsets[1:])
+            first = 0
+            while len(sizes) - first >= batch_size:
+                last = first + batch_size
+                yield data[offsets[first]:offsets[last]], offsets[first:last + 1] - offsets[first], headers[first:last]
+                first = last
+            pending = [(data[offsets[first]:], sizes[first:], headers[first:])]
+            pending_events = len(sizes) - first
+
+        if pending_events:
+            data, sizes, headers = (np.concatenate(arrays) for arrays in zip(*pending))
+            offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+            np.cumsum(sizes, out=offsets[1:])
+            yield data, offsets, headers
 
     def read_and_throw_previous_data(self, timeout=0.1, max_total_bytes = 10000):
         # print(f'  DEBUG: read_and_throw_previous_data (0) {self.host} {timeout}')
@@ -20,6 +20,8 @@ from tqdm import tqdm
 
 from VME_EASIROC import VmeEasiroc
 from Controller import CommandDispatcher
+from MultiReadout import MultiReadout
+from RBCPMultiplexer import RBCPMultiplexer
 
 # Set environment variable equivalent to ENV['INLINEDIR']
 os.environ['INLINEDIR'] = os.path.dirname(os.path.abspath(__file__))
@@ -36,6 +38,8 @@ class VmeEasirocGUI:
         self.ipaddr2 = tk.StringVar(value="192.168.10.17")
         self.easiroc_modules = {}
         self.dispatcher = {}
+        # Slow control of all modules through one UDP socket
+        self.rbcp_mux = RBCPMultiplexer()
         # Status texts
         self.status = {} 
         self.status['parent'] = tk.StringVar(value="Status: Not Connected") # Status for Module 1
@@ -47,6 +51,7 @@ class VmeEasirocGUI:
 
         # DAQ running flag
         self.daq_running = False
+        self.readout = None
 
         row_counter = 0
         # GUI Elements
@@ -209,18 +214,9 @@ class VmeEasirocGUI:
         try:
             # Easiroc instance
             print(f'Establishing connection to {name} module with ipaddr={ipaddr}')
-            vme_instance = VmeEasiroc(ipaddr, 24, 4660, 'yaml_'+name)
+            vme_instance = VmeEasiroc(ipaddr, 24, 4660, 'yaml_'+name, rbcp=self.rbcp_mux.handle(ipaddr, 4660))
             self.easiroc_modules[name] = vme_instance
-            self.easiroc_modules[name].send_slow_control()
-            self.easiroc_modules[name].send_probe_register()
-            self.easiroc_modules[name].send_read_register()
-            self.easiroc_modules[name].send_pedestal_suppression()
-            self.easiroc_modules[name].send_selectable_logic()
-            self.easiroc_modules[name].send_trigger_pla()
-            self.easiroc_modules[name].send_trigger_width()
-            self.easiroc_modules[name].send_time_window()
-            self.easiroc_modules[name].send_usr_clk_out_register()
-            self.easiroc_modules[name].send_trigger_values()
+            self.easiroc_modules[name].send_configuration()
             self.easiroc_modules[name].new_format = True
  
             # Queue
@@ -249,46 +245,44 @@ class VmeEasirocGUI:
         self.statusHV[name].set(f"HV: {self.dispatcher[name].dispatch('statusHV')} V")
  
     def start_daq(self, nevents, filename, nrepeats):
-        # Stop stdout on gui
-        #self.restore_original_stdout()
+        if self.daq_running:
+            print('DAQ is already running')
+            return
+        if not self.easiroc_modules:
+            print('Error: no module connected')
+            return
 
+        # Read every module from one selector loop, off the Tk thread
         self.daq_running = True
-
-        for i in range(nrepeats):
-            outputfilename1 = f'{filename}_parent_{i}.dat'
-            outputfilename2 = f'{filename}_child_{i}.dat'
-            print(f'Start DAQ: output files:{outputfilename1}, {outputfilename2}')
-            commandname1 = f'read {nevents} {outputfilename1} default'
-            commandname2 = f'read {nevents} {outputfilename2} default'
-
-            # excute command within threads
-            process1 = threading.Thread(target=self.dispatcher['parent'].dispatch, args=(commandname1,))
-            process2 = threading.Thread(target=self.dispatcher['child'].dispatch,  args=(commandname2,))
-
-            # Start processes
-            process1.start()
-            time.sleep(0.1) # slight delay
-            process2.start()
-
-            # Wait end of process --> Unstable 
-            process1.join()
-            process2.join()
-
-            time.sleep(1.0) # slight delay
-        
-        self.daq_running = False
-        # Restore stdout on GUI
-        #self.redirect_stdout_to_gui()
+        self.readout = MultiReadout(dict(self.easiroc_modules))
+        # Fill the spectra of each module's dispatcher, shown by its 'histogram' command
+        for name in self.readout.modules:
+            self.dispatcher[name].histograms.reset()
+            self.readout.monitors[name] = self.dispatcher[name].histograms
+        threading.Thread(target=self.run_daq, args=(nevents, filename, nrepeats), daemon=True).start()
+
+    def run_daq(self, nevents, filename, nrepeats):
+        try:
+            # The repeats are subruns of one continuous acquisition: no reconnect or pause in between
+            print(f'Start DAQ: {nrepeats} x {nevents} events into data/{filename}_<module>_<repeat>.dat')
+            statistics = self.readout.record_subruns(nevents, nrepeats, filename)
+            print(MultiReadout.format(statistics))
+            for name in self.readout.modules:
+                self.dispatcher[name].dispatch('slowcontrol')
+        except Exception as e:
+            print(f'DAQ stopped by error: {e}')
+        finally:
+            self.daq_running = False
 
     def stop_daq(self):
+        print("STOP button pressed. Attempting to stop measurement...")
         self.daq_running = False
+        if self.readout is not None:
+            self.readout.stop()
+        # a 'read' or 'continuous' started from a dispatcher stops on its own flag
+        for dispatcher in self.dispatcher.values():
+            dispatcher.dispatch('quit')
 
-        print("STOP button pressed. Attempting to stop measurement...")
-        if 'parent' in self.dispatcher:
-            self.dispatcher['parent'].dispatch('quit')
-        if 'child' in self.dispatcher:
-            self.dispatcher['child'].dispatch('quit')
-    
     def dispatch0(self, name, command):
         """Dispatch a command with no argument using CommandDispatcher."""
         if self.dispatcher[name]:
@@ -399,6 +393,7 @@ class VmeEasirocGUI:
                     self.status[key].set(f"Error during reset: {e}")
                     
         # Exit the application
+        self.rbcp_mux.close()
         self.root.destroy()
 
 class TextRedirector: